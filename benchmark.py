@@ -0,0 +1,261 @@
+#Load test and benchmark of the pi web services
+#   python benchmark.py load --route pi --rate 20 --concurrency 16 --duration 30 --output pi.json
+#   python benchmark.py replay traffic.jsonl --concurrency 16 --output replay.json
+#   python benchmark.py micro --simulations 1000000 --legacy 20 --output micro.json
+#   python benchmark.py load --route pi --baseline pi.json
+#   python benchmark.py startup --repeat 5 --output startup.json
+
+import argparse, json, math, os, subprocess, sys, tempfile, threading, time, timeit
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+URL = os.environ.get("PI_BENCH_URL", "http://localhost:5000")
+USERNAME, PASSWORD = "1110", "1110-pw"
+TIMEOUT = 120
+PERCENTILES = (50, 95, 99)
+
+def route_body(route, args):
+    body = {"username": USERNAME, "password": PASSWORD}
+    if route == "pi":
+        body.update(simulations=args.simulations, concurrency=args.shards)
+    elif route == "legacy_pi":
+        body.update(protocol=args.protocol, concurrency=args.shards)
+    return body
+
+def post(url, body):
+    req = Request(url=url, data=json.dumps(body).encode(), method="POST",
+                  headers={"Content-type": "application/json; charset=UTF-8"})
+    try:
+        with urlopen(req, timeout=TIMEOUT) as resp:
+            resp.read()
+            return resp.getcode()
+    except HTTPError as e:
+        return e.code
+    except (URLError, OSError):
+        return 0    #connection error or timeout
+
+def percentile(values, p):
+    #nearest rank, values are sorted
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summary(latencies, elapsed, statuses=None):
+    latencies = sorted(latencies)
+    result = {"requests": len(latencies), "throughput": len(latencies) / elapsed if elapsed else 0}
+    if statuses is not None:
+        result["errors"] = sum(n for status, n in statuses.items() if not 200 <= status < 300)
+        result["status"] = {str(status): n for status, n in sorted(statuses.items())}
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        result[f"p{p}_ms"] = value * 1000 if value is not None else None
+    result["mean_ms"] = sum(latencies) / len(latencies) * 1000 if latencies else None
+    result["max_ms"] = latencies[-1] * 1000 if latencies else None
+    return result
+
+#open loop, every request is sent at its scheduled time whether or not the earlier ones
+#have finished, and the latency is measured from the scheduled time so a slow server
+#is not hidden by the client waiting for it (coordinated omission)
+def run_schedule(url, schedule, concurrency):
+    latencies, statuses = defaultdict(list), defaultdict(Counter)
+    lock = threading.Lock()
+
+    def send(route, body, scheduled):
+        status = post(f"{url}/{route}", body)
+        latency = time.perf_counter() - scheduled
+        with lock:
+            latencies[route].append(latency)
+            statuses[route][status] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset, route, body in schedule:
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, route, body, scheduled)
+    elapsed = time.perf_counter() - start
+
+    results = {route: summary(latencies[route], elapsed, statuses[route]) for route in latencies}
+    results["total"] = summary([x for route in latencies for x in latencies[route]], elapsed,
+                               sum(statuses.values(), Counter()))
+    return results
+
+def load(args):
+    routes = ["pi", "legacy_pi", "statistics"] if args.route == "all" else [args.route]
+    count = max(1, int(args.rate * args.duration))
+    schedule = [(i / args.rate, routes[i % len(routes)], route_body(routes[i % len(routes)], args)) for i in range(count)]
+    return run_schedule(args.url, schedule, args.concurrency)
+
+#recorded traffic, one request per line: {"route": "/pi", "body": {...}, "time": 0.5}
+#"time" is the offset in seconds from the first request, without it the requests are sent at --rate
+def read_traffic(path, rate, speed):
+    schedule, skipped = [], 0
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                route, body = record["route"].strip("/"), record["body"]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                skipped += 1
+                continue
+            offset = record.get("time", len(schedule) / rate)
+            schedule.append((offset / speed, route, body))
+    schedule.sort(key=lambda x: x[0])
+    if schedule:
+        first = schedule[0][0]
+        schedule = [(offset - first, route, body) for offset, route, body in schedule]
+    return schedule, skipped
+
+def replay(args):
+    schedule, skipped = read_traffic(args.file, args.rate, args.speed)
+    if not schedule:
+        sys.exit(f"no requests in {args.file}, {skipped} lines skipped")
+    results = run_schedule(args.url, schedule, args.concurrency)
+    results["skipped_lines"] = skipped
+    return results
+
+def micro(args):
+    import s12755670_server as server
+    results = {}
+    for name, engine in server.ENGINES.items():
+        engine(1000, 1)     #numpy allocates its generator on the first call
+        times = timeit.repeat(lambda: engine(args.simulations, 1), number=1, repeat=args.repeat)
+        results[f"myth_value[{name}]"] = {
+            "simulations": args.simulations,
+            "best_s": min(times),
+            "median_s": sorted(times)[len(times) // 2],
+            "samples_per_s": args.simulations / min(times),
+        }
+    for name, fetch in (("legacy_pi_tcp", server.legacy_pi_tcp), ("legacy_pi_udp", server.legacy_pi_udp)):
+        latencies, failures = [], 0
+        start = time.perf_counter()
+        for _ in range(args.legacy):
+            t = time.perf_counter()
+            if fetch() is None:
+                failures += 1
+            latencies.append(time.perf_counter() - t)
+        results[name] = summary(latencies, time.perf_counter() - start)
+        results[name]["failures"] = failures
+    return results
+
+#cold start of a fresh interpreter per run and per start method of the worker pool, the
+#child imports the kernel and the server, builds the Flask app, starts the worker pool and
+#serves a first /pi. ready_s is the time from starting the child to its first /pi response
+def startup(args):
+    methods = [m for m in args.start_methods.split(",") if m in multiprocessing_start_methods()]
+    runs = {method: [] for method in methods}
+    for _ in range(args.repeat):
+        for method in methods:
+            with tempfile.TemporaryDirectory() as cwd:   #the child writes its own statistics
+                start = time.perf_counter()
+                child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "startup", "--child", "--simulations", str(args.simulations)],
+                                         cwd=cwd, env={**os.environ, "PI_POOL_START_METHOD": method}, stdout=subprocess.PIPE, text=True)
+                line = child.stdout.readline()
+                ready = time.perf_counter() - start
+                child.wait()
+            if not line:
+                sys.exit(f"startup child failed with {method}")
+            runs[method].append({**json.loads(line), "ready_s": ready})
+
+    results = {}
+    for method, times in runs.items():
+        results[method] = {stage: {"best_s": min(t[stage] for t in times), "median_s": sorted(t[stage] for t in times)[len(times) // 2]}
+                           for stage in times[0]}
+    return results
+
+def startup_child(args):
+    stages = {}
+    t = time.perf_counter()
+    import pi_kernel
+    stages["kernel_import_s"] = time.perf_counter() - t
+    t = time.perf_counter()
+    import s12755670_server as server
+    stages["server_import_s"] = time.perf_counter() - t
+    t = time.perf_counter()
+    app = server.get_app()
+    stages["app_s"] = time.perf_counter() - t
+    t = time.perf_counter()
+    server.get_pool()
+    stages["pool_s"] = time.perf_counter() - t
+    t = time.perf_counter()
+    body = {"username": USERNAME, "password": PASSWORD, "simulations": args.simulations, "concurrency": server.POOL_SIZE,
+            "engine": pi_kernel.DEFAULT_ENGINE}
+    status = app.test_client().post("/pi", json=body).status_code
+    stages["first_pi_s"] = time.perf_counter() - t
+    if status != 200:
+        sys.exit(f"first /pi failed with {status}")
+    print(json.dumps(stages), flush=True)
+    server.pool.shutdown()
+
+def multiprocessing_start_methods():
+    import multiprocessing
+    return multiprocessing.get_all_start_methods()
+
+#compare with an earlier run, a ratio over 1 is slower for latencies and faster for throughput
+def compare(results, baseline):
+    changes = {}
+    for name, metrics in results.items():
+        if not isinstance(metrics, dict) or not isinstance(baseline.get(name), dict):
+            continue
+        for key, value in metrics.items():
+            old = baseline[name].get(key)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                changes[f"{name}.{key}"] = value / old
+    return changes
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--url", default=URL)
+    common.add_argument("--output", help="save the results as JSON")
+    common.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser = argparse.ArgumentParser(description="Load test and benchmark of the pi web services")
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    for mode in ("load", "replay"):
+        sub = modes.add_parser(mode, parents=[common])
+        sub.add_argument("--rate", type=float, default=10, help="requests per second")
+        sub.add_argument("--concurrency", type=int, default=32, help="requests in flight at most")
+        if mode == "load":
+            sub.add_argument("--route", choices=["pi", "legacy_pi", "statistics", "all"], default="all")
+            sub.add_argument("--duration", type=float, default=10, help="seconds")
+            sub.add_argument("--simulations", type=int, default=100000)
+            sub.add_argument("--shards", type=int, default=4, help="concurrency field of the requests")
+            sub.add_argument("--protocol", choices=["tcp", "udp"], default="tcp")
+        else:
+            sub.add_argument("file", help="JSONL file of recorded requests")
+            sub.add_argument("--speed", type=float, default=1, help="replay speed, 2 is twice as fast")
+
+    sub = modes.add_parser("micro", parents=[common])
+    sub.add_argument("--simulations", type=int, default=1000000)
+    sub.add_argument("--repeat", type=int, default=5)
+    sub.add_argument("--legacy", type=int, default=10, help="legacy requests per protocol")
+
+    sub = modes.add_parser("startup", parents=[common])
+    sub.add_argument("--repeat", type=int, default=5)
+    sub.add_argument("--start-methods", default="forkserver,spawn,fork", help="start methods of the worker pool to compare")
+    sub.add_argument("--simulations", type=int, default=100000, help="simulations of the first /pi")
+    sub.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.mode == "startup" and args.child:
+        startup_child(args)
+        return
+    results = {"load": load, "replay": replay, "micro": micro, "startup": startup}[args.mode](args)
+    report = {"mode": args.mode, "time": time.time(),
+              "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+              "results": results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline"] = {"file": args.baseline, "ratio": compare(results, json.load(f)["results"])}
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 # TCP/UDP pi server
 
-import logging, math, random, string, sys, threading, time
+import argparse, asyncio, logging, math, queue, random, select, signal, socket, string, threading, time
+from concurrent.futures import Future
 from socketserver import (
         BaseRequestHandler, ThreadingTCPServer, ThreadingUDPServer)
 
 HOST, PORT = "0.0.0.0", 31416
+DELAY = 0.5
+PIPELINE_HEADER = b"PIPELINE\n"    #opt-in keep-alive mode, one request per line, answered in order
+PIPELINE_IDLE_TIMEOUT = 60
+PIPELINE_MAX_QUEUE = 64     #replies outstanding per connection before the server stops reading
+MAX_INFLIGHT = 10000    #asyncio backend, requests over the cap are dropped
+SHUTDOWN_GRACE = 5      #asyncio backend, seconds to finish the requests in flight
 
 def compute_pi():
     error = 0.1 * (random.random() - 0.5)
@@ -15,17 +22,55 @@ def compute_pi():
         pi = pi[:pos] + ch + pi[pos+1:]
     return pi
 
-def delay():
-    time.sleep(0.5)
+def delay(seconds=DELAY):
+    time.sleep(seconds)
 
 def tcp_server(host, port):
     class TCPClientHandler(BaseRequestHandler):
         def handle(self):
             logging.info(f"TCP client connected from {self.client_address}")
-            delay()
             with self.request as cs:
+                #old clients send nothing, so the header is only waited for during the delay
+                start = time.monotonic()
+                if select.select([cs], [], [], DELAY)[0] and cs.recv(len(PIPELINE_HEADER), socket.MSG_PEEK) == PIPELINE_HEADER:
+                    cs.recv(len(PIPELINE_HEADER))
+                    self.pipeline(cs)
+                    return
+                delay(max(0, DELAY - (time.monotonic() - start)))
                 cs.sendall(compute_pi().encode())
 
+        #every request gets its own timer, a writer thread sends the replies in the order of the requests
+        def pipeline(self, cs):
+            logging.info(f"TCP client {self.client_address} switched to pipeline mode")
+            cs.settimeout(PIPELINE_IDLE_TIMEOUT)
+            replies = queue.Queue(PIPELINE_MAX_QUEUE)
+            writer = threading.Thread(target=self.send_replies, args=(cs, replies))
+            writer.start()
+            with cs.makefile("rb") as requests:
+                try:
+                    for _ in requests:
+                        reply = Future()
+                        threading.Timer(DELAY, lambda reply=reply: reply.set_result(compute_pi())).start()
+                        replies.put(reply)     #waits while PIPELINE_MAX_QUEUE replies are outstanding
+                except OSError:     #idle timeout or client gone
+                    pass
+            replies.put(None)
+            writer.join()
+
+        def send_replies(self, cs, replies):
+            broken = False
+            while True:
+                reply = replies.get()
+                if reply is None:
+                    return
+                pi = reply.result()
+                if broken:      #keep draining so the reader never waits on a full queue
+                    continue
+                try:
+                    cs.sendall(pi.encode() + b"\n")
+                except OSError:
+                    broken = True
+
     server = ThreadingTCPServer((host, port), TCPClientHandler)
     def run_server():
         with server:
@@ -54,11 +99,153 @@ def udp_server(host, port):
     threading.Thread(target=run_server).start()
     return server
 
+#single threaded backend, the delay is a timer on the event loop instead of a
+#sleeping thread, so thousands of clients cost no more than their sockets
+class AsyncioServer:
+    def __init__(self, host, port, max_inflight):
+        self.host, self.port = host, port
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.stopping = False
+        self.drained = None
+
+    def acquire(self, client):
+        if self.stopping or self.inflight >= self.max_inflight:
+            logging.warning(f"Dropped request from {client}, {self.inflight} requests in flight")
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self):
+        self.inflight -= 1
+        if self.stopping and self.inflight == 0:
+            self.drained.set()
+
+    async def handle_tcp(self, reader, writer):
+        client = writer.get_extra_info("peername")
+        logging.info(f"TCP client connected from {client}")
+        try:
+            if not self.acquire(client):
+                return
+            try:
+                #old clients send nothing, so the header is only waited for during the delay
+                start = time.monotonic()
+                try:
+                    header = await asyncio.wait_for(reader.readline(), DELAY)
+                except asyncio.TimeoutError:
+                    header = None
+                if header != PIPELINE_HEADER:
+                    await asyncio.sleep(max(0, DELAY - (time.monotonic() - start)))
+                    writer.write(compute_pi().encode())
+                    await writer.drain()
+                    return
+            finally:
+                self.release()
+            logging.info(f"TCP client {client} switched to pipeline mode")
+            await self.pipeline(reader, writer, client)
+        except (OSError, asyncio.TimeoutError):    #idle timeout or client gone
+            pass
+        finally:
+            writer.close()
+
+    #every request gets its own timer, a writer task sends the replies in the order of the requests
+    async def pipeline(self, reader, writer, client):
+        loop = asyncio.get_running_loop()
+        replies = asyncio.Queue(PIPELINE_MAX_QUEUE)
+        sender = asyncio.create_task(self.send_replies(writer, replies))
+        try:
+            while not self.stopping:
+                if not await asyncio.wait_for(reader.readline(), PIPELINE_IDLE_TIMEOUT):
+                    break
+                if not self.acquire(client):
+                    break
+                reply = loop.create_future()
+                loop.call_later(DELAY, reply.set_result, compute_pi())
+                await replies.put(reply)     #waits while PIPELINE_MAX_QUEUE replies are outstanding
+        finally:
+            await replies.put(None)
+            await sender
+
+    async def send_replies(self, writer, replies):
+        while True:
+            reply = await replies.get()
+            if reply is None:
+                return
+            try:
+                pi = await reply
+                if not writer.is_closing():     #keep draining so the reader never waits on a full queue
+                    writer.write(pi.encode() + b"\n")
+                    await writer.drain()
+            except OSError:
+                writer.close()
+            finally:
+                self.release()
+
+    def udp_protocol(self):
+        server = self
+        loop = asyncio.get_running_loop()
+
+        class UDPClientProtocol(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                logging.info(f"UDP client request from {addr}")
+                if server.acquire(addr):
+                    loop.call_later(DELAY, self.reply, addr)
+
+            def reply(self, addr):
+                try:
+                    self.transport.sendto(compute_pi().encode(), addr)
+                finally:
+                    server.release()
+
+        return UDPClientProtocol()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.drained = asyncio.Event()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        #bursts of thousands of clients need a longer accept queue and a bigger receive buffer
+        tcp = await asyncio.start_server(self.handle_tcp, self.host, self.port, backlog=min(self.max_inflight, 4096))
+        logging.info(f"TCP server started, listening on {(self.host, self.port)}")
+        udp, _ = await loop.create_datagram_endpoint(self.udp_protocol, local_addr=(self.host, self.port))
+        udp.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        logging.info(f"UDP server started, bound to {(self.host, self.port)}")
+        logging.info("Press Ctrl-C to terminate the server")
+        await stop.wait()
+
+        #graceful shutdown, stop taking requests and answer the ones in flight
+        logging.info(f"Exiting, {self.inflight} requests in flight")
+        self.stopping = True
+        tcp.close()
+        if self.inflight:
+            try:
+                await asyncio.wait_for(self.drained.wait(), SHUTDOWN_GRACE)
+            except asyncio.TimeoutError:
+                logging.warning(f"{self.inflight} requests not answered")
+        udp.close()
+        logging.info("TCP and UDP server exited")
+
 def main():
+    parser = argparse.ArgumentParser(description="TCP/UDP pi server")
+    parser.add_argument("host", nargs="?", default=HOST)
+    parser.add_argument("port", nargs="?", type=int, default=PORT)
+    parser.add_argument("--backend", choices=["thread", "asyncio"], default="thread",
+                        help="thread: one thread per request (default), asyncio: one event loop")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT,
+                        help="asyncio backend, requests in flight before new ones are dropped")
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
-    host = sys.argv[1] if len(sys.argv) > 1 else HOST
-    port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
-    servers = (tcp_server(host, port), udp_server(host, port))
+    if args.backend == "asyncio":
+        asyncio.run(AsyncioServer(args.host, args.port, args.max_inflight).serve())
+        return
+
+    servers = (tcp_server(args.host, args.port), udp_server(args.host, args.port))
     logging.info("Press Ctrl-C to terminate the server")
     try:
         while True:
@@ -0,0 +1,291 @@
+#Compute kernel of the Pi web service, everything the worker processes run. It only
+#imports the standard library (numpy on first use), so the worker processes load it
+#without Flask or the rest of s12755670_server.py
+
+import os, sys, re, math, struct, threading, importlib.util
+from collections import Counter
+from random import Random
+
+BLOCK_SIZE = 1 << 16    #samples per random stream, also bounds numpy memory to ~1MB
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None     #numpy is optional, fall back to the python loop
+np = None
+
+#sampling profiler, a thread takes the stacks of the profiled threads every interval and
+#counts them as collapsed stacks ("root;caller;callee count"), the input of flamegraph.pl
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+class SamplingProfiler:
+    def __init__(self, interval, threads=None, label=None):
+        self.interval = interval
+        self.threads = threads      #thread idents, None samples all the threads
+        self.label = label          #root frame, the thread name by default
+        self.path = None
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: re.sub(r"-\d+", "", thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me and (self.threads is None or ident in self.threads):
+                    stack = f"{self.label or names.get(ident, 'thread')};{collapse(frame)}"
+                    with self.lock:
+                        self.stacks[stack] += 1
+
+    def add(self, stacks):
+        with self.lock:
+            self.stacks.update(stacks)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+#runs a shard in a worker process under its own profiler, the stacks go back with the hits
+def profile_shard(estimator, interval, n, seed, block):
+    profiler = SamplingProfiler(interval, {threading.get_ident()}, "worker").start()
+    try:
+        hits = estimator(n, seed, block)
+    finally:
+        profiler.stop()
+    return hits, dict(profiler.stacks)
+
+#R1
+#every block of BLOCK_SIZE samples has its own stream derived from (seed, block),
+#so the result only depends on the seed and not on how the blocks are sharded
+def myth_value(n, seed, block=0):
+    count = 0
+    while n > 0:
+        size = min(n, BLOCK_SIZE)
+        random = Random(f"{seed}/{block}").random
+        for _ in range(size):
+            x = random()
+            y = random()
+            if x * x + y * y < 1:
+                count += 1
+        n -= size
+        block += 1
+    return count
+
+#the buffers are kept for the life of the worker process, fresh ones would be page
+#faulted in again by every call, which costs as much as drawing a small shard. Every
+#numpy estimator starts here, so numpy is imported by the first numpy shard
+numpy_buffers = None
+
+def get_numpy_buffers():
+    global np, numpy_buffers
+    if numpy_buffers is None:
+        import numpy as np
+        numpy_buffers = np.empty(BLOCK_SIZE), np.empty(BLOCK_SIZE)
+    return numpy_buffers
+
+def myth_value_numpy(n, seed, block=0):
+    buffers = get_numpy_buffers()
+    count = 0
+    while n > 0:
+        size = min(n, BLOCK_SIZE)
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(block,)))   #same as SeedSequence(seed).spawn()[block]
+        x = rng.random(size, out=buffers[0][:size])
+        y = rng.random(size, out=buffers[1][:size])
+        x *= x
+        y *= y
+        x += y
+        count += int(np.count_nonzero(x < 1))
+        n -= size
+        block += 1
+    return count
+
+#quasi-Monte Carlo, the points of block b are the Halton points (bases 2 and 3) numbered
+#from b*BLOCK_SIZE+1, shifted modulo 1 by an offset drawn from the stream of the block.
+#Every block is an independent unbiased estimate and the spread between the blocks gives
+#the error, returns (hits, moment) with moment the sum of hits**2 scaled to full blocks
+def radical_inverse(i, base):
+    value, f = 0.0, 1.0 / base
+    while i:
+        i, digit = divmod(i, base)
+        value += digit * f
+        f /= base
+    return value
+
+def qmc_value(n, seed, block=0):
+    hits = moment = 0
+    while n > 0:
+        size = min(n, BLOCK_SIZE)
+        random = Random(f"{seed}/{block}").random
+        shift_x, shift_y = random(), random()
+        count = 0
+        for i in range(block * BLOCK_SIZE + 1, block * BLOCK_SIZE + size + 1):
+            x = (radical_inverse(i, 2) + shift_x) % 1.0
+            y = (radical_inverse(i, 3) + shift_y) % 1.0
+            if x * x + y * y < 1:
+                count += 1
+        hits += count
+        moment += count * count * BLOCK_SIZE // size
+        n -= size
+        block += 1
+    return hits, moment
+
+#radical inverses of [0, base**k) up to BLOCK_SIZE, so the numpy version takes k digits at a time
+radical_tables = {}
+
+def radical_inverse_numpy(indices, base, out):
+    table = radical_tables.get(base)
+    if table is None:
+        size = base
+        while size * base <= BLOCK_SIZE:
+            size *= base
+        table = radical_tables[base] = np.array([radical_inverse(i, base) for i in range(size)])
+    out[:] = 0
+    scale = 1.0
+    while indices.any():
+        indices, digits = np.divmod(indices, len(table))
+        out += table[digits] * scale
+        scale /= len(table)
+    return out
+
+def qmc_value_numpy(n, seed, block=0):
+    buffers = get_numpy_buffers()
+    hits = moment = 0
+    while n > 0:
+        size = min(n, BLOCK_SIZE)
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(block,)))
+        shift_x, shift_y = rng.random(2)
+        indices = np.arange(block * BLOCK_SIZE + 1, block * BLOCK_SIZE + size + 1, dtype=np.int64)
+        x = radical_inverse_numpy(indices, 2, buffers[0][:size])
+        y = radical_inverse_numpy(indices, 3, buffers[1][:size])
+        x += shift_x
+        np.subtract(x, 1, out=x, where=x >= 1)     #modulo 1, much faster than %=
+        y += shift_y
+        np.subtract(y, 1, out=y, where=y >= 1)
+        x *= x
+        y *= y
+        x += y
+        count = int(np.count_nonzero(x < 1))
+        hits += count
+        moment += count * count * BLOCK_SIZE // size
+        n -= size
+        block += 1
+    return hits, moment
+
+#stratified sampling, a block of n samples puts one jittered point in every cell of a
+#k x k grid (k = isqrt(n)) and draws the rest uniformly. Only the 2k-1 cells on the arc
+#can miss or hit, so the variance of the hits is at most (2k-1 + rest)/4, returns
+#(hits, moment) with moment the sum of 2k-1 + rest
+def stratified_value(n, seed, block=0):
+    hits = moment = 0
+    while n > 0:
+        size = min(n, BLOCK_SIZE)
+        random = Random(f"{seed}/{block}").random
+        k = math.isqrt(size)
+        count = 0
+        for i in range(k):
+            for j in range(k):
+                x = (i + random()) / k
+                y = (j + random()) / k
+                if x * x + y * y < 1:
+                    count += 1
+        for _ in range(size - k * k):
+            x = random()
+            y = random()
+            if x * x + y * y < 1:
+                count += 1
+        hits += count
+        moment += 2 * k - 1 + size - k * k
+        n -= size
+        block += 1
+    return hits, moment
+
+def stratified_value_numpy(n, seed, block=0):
+    buffers = get_numpy_buffers()
+    hits = moment = 0
+    while n > 0:
+        size = min(n, BLOCK_SIZE)
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(block,)))
+        k = math.isqrt(size)
+        cells = k * k
+        x = rng.random(size, out=buffers[0][:size])
+        y = rng.random(size, out=buffers[1][:size])
+        i, j = np.divmod(np.arange(cells), k)
+        x[:cells] += i
+        x[:cells] /= k
+        y[:cells] += j
+        y[:cells] /= k
+        x *= x
+        y *= y
+        x += y
+        count = int(np.count_nonzero(x < 1))
+        hits += count
+        moment += 2 * k - 1 + size - cells
+        n -= size
+        block += 1
+    return hits, moment
+
+ENGINES = {"python": myth_value}
+if HAS_NUMPY:
+    ENGINES["numpy"] = myth_value_numpy
+DEFAULT_ENGINE = "numpy" if "numpy" in ENGINES else "python"
+
+#estimators of the sampling methods by engine, the series does not sample
+ESTIMATORS = {"monte_carlo": ENGINES, "qmc": {"python": qmc_value}, "stratified": {"python": stratified_value}}
+if HAS_NUMPY:
+    ESTIMATORS["qmc"]["numpy"] = qmc_value_numpy
+    ESTIMATORS["stratified"]["numpy"] = stratified_value_numpy
+
+#the estimators return hits, or (hits, moment) when the error needs more than the hit count
+def shard_tally(value):
+    return value if isinstance(value, tuple) else (value, 0)
+
+#one (hits, samples, moment) int64 slot per shard of the file mapped by the parent
+SHARD_SLOT = struct.Struct("qqq")
+
+#runs the shards [(samples, first block)] numbered from `first`, under a profiler when
+#`interval` is set, and returns the stacks or None
+def account_shards(estimator, path, seed, first, shards, interval=None):
+    profiler = SamplingProfiler(interval, {threading.get_ident()}, "worker").start() if interval else None
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for i, (n, block) in enumerate(shards, first):
+            hits, moment = shard_tally(estimator(n, seed, block))
+            os.pwrite(fd, SHARD_SLOT.pack(hits, n, moment), i * SHARD_SLOT.size)
+    finally:
+        os.close(fd)
+        if profiler is not None:
+            profiler.stop()
+    return dict(profiler.stacks) if profiler is not None else None
+
+#Chudnovsky series by binary splitting, every term adds ~14.18 digits. A range of terms
+#[a, b) reduces to the integers (P, Q, T) and two neighbouring ranges merge exactly, so
+#the terms are split into `concurrency` ranges that run in the worker pool
+def chudnovsky_terms(a, b):
+    if b - a == 1:
+        if a == 0:
+            p = q = 1
+        else:
+            p = (6 * a - 5) * (2 * a - 1) * (6 * a - 1)
+            q = a * a * a * 10939058860032000
+        t = p * (13591409 + 545140134 * a)
+        return p, q, -t if a & 1 else t
+    m = (a + b) // 2
+    return merge_terms(chudnovsky_terms(a, m), chudnovsky_terms(m, b))
+
+def merge_terms(left, right):
+    p1, q1, t1 = left
+    p2, q2, t2 = right
+    return p1 * p2, q1 * q2, t1 * q2 + p1 * t2
+
+def warm_up():
+    return os.getpid()
@@ -0,0 +1,132 @@
+#Production entry point, serves the route logic of s12755670_server.py as an ASGI app
+#with several worker processes:
+#   python s12755670_asgi.py --host 0.0.0.0 --port 5000 --workers 4
+
+import argparse, asyncio, json, os, timeit
+from concurrent.futures import ThreadPoolExecutor
+import s12755670_server as server
+try:
+    import uvicorn
+    from uvicorn.middleware.wsgi import WSGIMiddleware
+except ImportError:     #uvicorn is only needed to run the entry point
+    uvicorn = None
+
+HOST, PORT = "localhost", 5000
+WORKERS = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+HANDLER_THREADS = int(os.environ.get("WEB_HANDLER_THREADS", 64))   #threads waiting on the worker pool or legacy client
+SHUTDOWN_GRACE = int(os.environ.get("WEB_SHUTDOWN_GRACE", 60))     #seconds to drain the requests in flight
+
+ROUTES = {
+    "/pi": server.handle_pi,
+    "/legacy_pi": server.handle_legacy_pi,
+    "/statistics": server.handle_statistics,
+    "/batch": server.handle_batch,
+}
+
+#the handlers only wait on the worker pool and the legacy client, so they run in a
+#thread pool and the event loop is never blocked
+executor = ThreadPoolExecutor(max_workers=HANDLER_THREADS)
+flask_app = None    #the other routes, /pi/stream, /pi/jobs, /batch/stream, /cache
+
+#Flask is only imported by the first request to one of the other routes
+def get_flask_app():
+    global flask_app
+    if flask_app is None:
+        flask_app = WSGIMiddleware(server.get_app())
+    return flask_app
+
+async def send_json(send, body, status=200, headers=()):
+    data = json.dumps(body).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": data})
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            server.get_pool()
+            server.get_stats_store()
+            server.get_legacy_client()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            #the server has stopped taking requests and waited for the ones in flight,
+            #let the Pi jobs finish before the worker pool is shut down and flush the statistics
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, executor.shutdown)
+            await loop.run_in_executor(None, server.job_store.shutdown, SHUTDOWN_GRACE)
+            await loop.run_in_executor(None, server.pool.shutdown)
+            server.legacy_client.close()
+            server.stats_store.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    handler = ROUTES.get(scope["path"])
+    if handler is None:
+        if uvicorn is not None:
+            await get_flask_app()(scope, receive, send)
+        else:
+            await send_json(send, {"error": "not found"}, 404)
+        return
+    start_time = timeit.default_timer()
+    status = await handle(handler, scope, receive, send)
+    server.record_request(scope["path"], scope["method"], status, timeit.default_timer() - start_time)
+
+async def handle(handler, scope, receive, send):
+    if scope["method"] != "POST":
+        await send_json(send, {"error": "method not allowed"}, 405, [(b"allow", b"POST")])
+        return 405
+
+    try:
+        data = json.loads(await read_body(receive))
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        await send_json(send, {"error": "invalid json"}, 400)
+        return 400
+
+    loop = asyncio.get_running_loop()
+    token = dict(scope["headers"]).get(b"x-profile") if server.profiles.token else None
+    headers = []
+    try:
+        if token is not None and server.profiles.authorized(token.decode(errors="replace")):
+            (body, status), path = await loop.run_in_executor(executor, server.profiles.call, scope["path"], handler, data)
+            headers.append((b"x-profile-file", path.encode()))
+        else:
+            body, status = await loop.run_in_executor(executor, handler, data)
+    except server.RateLimited as e:
+        body, status, retry = e.response()
+        headers += [(name.lower().encode(), value.encode()) for name, value in retry.items()]
+    await send_json(send, body, status, headers)
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description="Production server of the pi web services")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    #only the statistics are shared, the Pi jobs, result cache, metrics, profiles and
+    #rate limits are kept by each worker process
+    parser.add_argument("--workers", type=int, default=WORKERS, help="web worker processes")
+    args = parser.parse_args()
+    if uvicorn is None:
+        parser.error("uvicorn is not installed, pip install uvicorn")
+
+    #every web worker has its own pool of compute processes, split the cores between them
+    os.environ.setdefault("PI_POOL_SIZE", str(max(1, (os.cpu_count() or 1) // args.workers)))
+    uvicorn.run("s12755670_asgi:app", host=args.host, port=args.port, workers=args.workers,
+                lifespan="on", timeout_graceful_shutdown=SHUTDOWN_GRACE)
+
+if __name__ == "__main__":
+    main()
@@ -1,183 +1,1818 @@
-import os, timeit, threading, socket
-from flask import Flask, request, jsonify
-from random import random
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os, time, math, decimal, mmap, tempfile, timeit, threading, atexit, secrets, hmac, hashlib, json, uuid, sqlite3, asyncio, re, multiprocessing
+from statistics import median
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from functools import partial, wraps
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from pi_kernel import (BLOCK_SIZE, HAS_NUMPY, ENGINES, ESTIMATORS, DEFAULT_ENGINE, SHARD_SLOT, SamplingProfiler,
+                       profile_shard, shard_tally, account_shards, chudnovsky_terms, merge_terms, warm_up)
 
-app = Flask(__name__)
 HOST, PORT = "localhost", 5000
 LEGACY_HOST, LEGACY_PORT = "localhost", 31416
+LEGACY_TIMEOUT = float(os.environ.get("LEGACY_TIMEOUT", 1))             #seconds per attempt
+LEGACY_DEADLINE = float(os.environ.get("LEGACY_DEADLINE", 3))           #seconds for one value, all attempts included
+LEGACY_RETRIES = int(os.environ.get("LEGACY_RETRIES", 2))
+LEGACY_HEDGE_DELAY = float(os.environ.get("LEGACY_HEDGE_DELAY", 0.75))  #send one more request when no reply by then
+LEGACY_MAX_INFLIGHT = int(os.environ.get("LEGACY_MAX_INFLIGHT", 64))    #requests to the legacy server, shared by all clients
+LEGACY_MAX_CONCURRENCY = int(os.environ.get("LEGACY_MAX_CONCURRENCY", 64))
+LEGACY_MAX_ROUNDS = 8          #rounds of `concurrency` requests to reach target_valid
+LEGACY_MAX_ERROR = 0.05        #the legacy server adds up to +-0.05 to pi
+LEGACY_RECOVER_TOLERANCE = float(os.environ.get("LEGACY_RECOVER_TOLERANCE", 0.001))
+LEGACY_TRIM = 0.2              #fraction cut from each end by the trimmed estimator
+LEGACY_ESTIMATORS = ["mean", "median", "trimmed", "consensus"]
+LEGACY_KEEPALIVE = os.environ.get("LEGACY_KEEPALIVE", "0") == "1"     #pipeline mode of the legacy server, needs the new legacy_pi_server.py
+LEGACY_POOL_SIZE = int(os.environ.get("LEGACY_POOL_SIZE", 16))          #kept-alive TCP connections
+LEGACY_PIPELINE_HEADER = b"PIPELINE\n"
 STATS_FILE = 'user_statistics.txt'
-lock = threading.Lock() 
+STATS_DB = os.environ.get("STATS_DB", 'user_statistics.db')
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", 1))    #seconds, 0 writes every request through
+POOL_SIZE = int(os.environ.get("PI_POOL_SIZE", os.cpu_count() or 1))
+POOL_START_METHOD = os.environ.get("PI_POOL_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+POOL_PRELOAD = ["__main__", "pi_kernel"] + (["numpy"] if HAS_NUMPY else [])   #imported once by the forkserver
+MAX_SIMULATIONS = 100000000
+TIME_BUDGET = 30        #default seconds for the precision mode of /pi
+Z_95 = 1.96
+#the most `digits` the precision mode can reach within MAX_SIMULATIONS, the standard error at 1e8
+#samples is about 1.6e-4 for monte_carlo and 2e-5 for qmc and stratified, 4 digits need 2.55e-5
+PRECISION_MAX_DIGITS = {"monte_carlo": 3, "qmc": 4, "stratified": 4}
+JOB_QUEUE_SIZE = int(os.environ.get("PI_JOB_QUEUE_SIZE", 16))
+JOB_WORKERS = int(os.environ.get("PI_JOB_WORKERS", 2))
+JOB_TTL = int(os.environ.get("PI_JOB_TTL", 600))   #seconds a finished job is kept
+JOB_RETRY_AFTER = 5
+CACHE_TTL = int(os.environ.get("PI_CACHE_TTL", 3600))
+CACHE_MAX_BYTES = int(os.environ.get("PI_CACHE_MAX_BYTES", 16 << 20))
+LEGACY_CACHE_TTL = float(os.environ.get("LEGACY_CACHE_TTL", 0))    #freshness window of /legacy_pi results, 0 disables
+BATCH_MAX_ITEMS = int(os.environ.get("PI_BATCH_MAX_ITEMS", 100))
+BATCH_STATISTICS = os.environ.get("PI_BATCH_STATISTICS", "batch")   #"batch" counts a /batch request once, "item" once per item
+BATCH_WORKERS = int(os.environ.get("PI_BATCH_WORKERS", 32))          #threads waiting on the items of all batches
+SHARDS_PER_TASK = int(os.environ.get("PI_SHARDS_PER_TASK", 32))     #shards a worker runs per task with shard accounting
+SHM_DIR = os.environ.get("PI_SHM_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+METHODS = ["monte_carlo", "qmc", "stratified", "series"]
+QMC_MIN_BLOCKS = 8      #blocks needed to estimate the qmc error from their spread
+SERIES_MAX_DIGITS = int(os.environ.get("PI_SERIES_MAX_DIGITS", 100000))
+SERIES_GUARD_DIGITS = 10
+CREDENTIALS_FILE = os.environ.get("PI_CREDENTIALS", "")    #JSON file of username -> password hash, empty keeps the built-in rule
+PASSWORD_ITERATIONS = 100000
+AUTH_CACHE_TTL = float(os.environ.get("PI_AUTH_CACHE_TTL", 60))    #seconds a verified password is remembered
+AUTH_CACHE_SIZE = 10000
+RATE_LIMIT = float(os.environ.get("PI_RATE_LIMIT", 50))            #requests per second per user, 0 disables
+RATE_BURST = float(os.environ.get("PI_RATE_BURST", 100))
+SIMULATIONS_PER_MINUTE = int(os.environ.get("PI_SIMULATIONS_PER_MINUTE", 1000000000))   #compute quota per user, 0 disables
+PROFILE_TOKEN = os.environ.get("PI_PROFILE_TOKEN", "")     #admin token of the X-Profile header and /profile, empty disables profiling
+PROFILE_DIR = os.environ.get("PI_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.environ.get("PI_PROFILE_INTERVAL", 0.005))  #seconds between samples
+PROFILE_MAX_WINDOW = 600
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  #seconds
 
-#R1
-def myth_value(n):
-    count = 0
-    for _ in range(n):
-        x = random()
-        y = random()
-        if x * x + y * y < 1:
-            count += 1
-    return count
+#the Flask app is built by get_app() on first use, so importing this module (the ASGI
+#routes, the tests, the forkserver that imports the main script) does not import Flask.
+#The decorators of `routes` record the views and hooks and get_app() registers them.
+#`app` is still the Flask app for `flask --app s12755670_server` and
+#`gunicorn s12755670_server:app`, it is built by the first lookup of the attribute
+Response = request = jsonify = g = None     #from flask, set by get_app()
 
-#R2
-def is_float(n):    #check the string is/isnot valid float
-    if 'e' in n.lower():    #avoid e
-        return False
+class DeferredApp:
+    def __init__(self, name):
+        self.name = name
+        self.setup = []     #(method of the Flask app, args, function) in declaration order
+        self.app = None
+        self.lock = threading.Lock()
+
+    def _record(self, method, *args):
+        def decorator(f):
+            self.setup.append((method, args, f))
+            return f
+        return decorator
+
+    def get(self, rule):
+        return self._record("get", rule)
+
+    def post(self, rule):
+        return self._record("post", rule)
+
+    def errorhandler(self, exception):
+        return self._record("errorhandler", exception)
+
+    def before_request(self, f):
+        return self._record("before_request")(f)
+
+    def after_request(self, f):
+        return self._record("after_request")(f)
+
+    def teardown_request(self, f):
+        return self._record("teardown_request")(f)
+
+    def get_app(self):
+        global Response, request, jsonify, g
+        with self.lock:
+            if self.app is None:
+                start_time = timeit.default_timer()
+                import flask
+                Response, request, jsonify, g = flask.Response, flask.request, flask.jsonify, flask.g
+                app = flask.Flask(self.name)
+                for method, args, f in self.setup:
+                    register = getattr(app, method)
+                    (register(*args) if args else register)(f)
+                self.app = app
+                metrics.observe("pi_stage_seconds", timeit.default_timer() - start_time, stage="app_start")
+        return self.app
+
+routes = DeferredApp(__name__)
+
+def get_app():
+    return routes.get_app()
+
+def __getattr__(name):
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+#counters, latency histograms and gauges of this process, rendered by /metrics in the
+#Prometheus text format. The stages of a request are timed into pi_stage_seconds
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.help = {}
+        self.counters = {}      #(name, labels) -> value
+        self.histograms = {}    #(name, labels) -> [count per bucket, sum, count]
+        self.gauges = {}        #name -> function returning the value
+        self.lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    @contextmanager
+    def timer(self, stage):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe("pi_stage_seconds", timeit.default_timer() - start, stage=stage)
+
+    def timed(self, stage):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(counts), total, count) for key, (counts, total, count) in self.histograms.items()}
+        series = {}     #(name, type) -> lines of (sample name, labels, value)
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault((name, "counter"), []).append((name, labels, value))
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            lines = series.setdefault((name, "histogram"), [])
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                lines.append((f"{name}_bucket", labels + (("le", str(bound)),), cumulative))
+            lines += [(f"{name}_sum", labels, total), (f"{name}_count", labels, count)]
+        for name, function in self.gauges.items():
+            series[(name, "gauge")] = [(name, (), function())]
+
+        out = []
+        for (name, kind), lines in sorted(series.items()):
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in lines:
+                out.append(f"{sample}{format_labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics(METRICS_BUCKETS)
+metrics.describe("http_requests_total", "HTTP requests by route, method and status code.")
+metrics.describe("http_request_duration_seconds", "Latency of the HTTP requests by route.")
+metrics.describe("pi_stage_seconds", "Time spent in each stage of a request.")
+metrics.describe("legacy_attempts_total", "Requests sent to the legacy server by protocol and result.")
+
+#profiles of one request (X-Profile header) or of every request in a time window
+#(/profile), saved as collapsed stack files in PROFILE_DIR. When profiling is off the
+#only cost is current() in run_shards
+class Profiles:
+    def __init__(self, token, directory, interval):
+        self.token = token
+        self.directory = directory
+        self.interval = interval
+        self.local = threading.local()
+        self.window = None
+        self.lock = threading.Lock()
+
+    def authorized(self, token):
+        return bool(self.token) and isinstance(token, str) and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def current(self):
+        profiler = getattr(self.local, "profiler", None)
+        return profiler if profiler is not None else self.window
+
+    def new_path(self, name):
+        name = re.sub(r"[^A-Za-z0-9_.]+", "_", name.strip("/")) or "root"
+        return os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}.folded")
+
+    def start_request(self, name):
+        profiler = SamplingProfiler(self.interval, {threading.get_ident()}, "request")
+        profiler.path = self.new_path(name)
+        self.local.profiler = profiler.start()
+        return profiler
+
+    def stop_request(self, profiler):
+        if getattr(self.local, "profiler", None) is profiler:
+            self.local.profiler = None
+        self.save(profiler.path, profiler.stop())
+
+    def call(self, name, function, *args):
+        profiler = self.start_request(name)
+        try:
+            return function(*args), profiler.path
+        finally:
+            self.stop_request(profiler)
+
+    #returns the path of the profile or None when a window is already running
+    def start_window(self, seconds):
+        with self.lock:
+            if self.window is not None:
+                return None
+            profiler = SamplingProfiler(self.interval)
+            profiler.path = self.new_path("window")
+            self.window = profiler.start()
+        timer = threading.Timer(seconds, self.stop_window, (profiler,))
+        timer.daemon = True
+        timer.start()
+        return profiler.path
+
+    def stop_window(self, profiler):
+        with self.lock:
+            if self.window is profiler:
+                self.window = None
+        self.save(profiler.path, profiler.stop())
+
+    def save(self, path, stacks):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+
+profiles = Profiles(PROFILE_TOKEN, PROFILE_DIR, PROFILE_INTERVAL)
+
+#split the blocks of samples [start, simulations) into at most `concurrency` shards of
+#(samples, first block), the remainder is spread over the first shards so every sample is counted once
+def split_shards(simulations, concurrency, start=0):
+    first = start // BLOCK_SIZE
+    blocks = -(-simulations // BLOCK_SIZE) - first
+    per_shard, extra = divmod(blocks, min(concurrency, blocks))
+    shards = []
+    for i in range(min(concurrency, blocks)):
+        last = first + per_shard + (1 if i < extra else 0)
+        shards.append((min(last * BLOCK_SIZE, simulations) - first * BLOCK_SIZE, first))
+        first = last
+    return shards
+
+def standard_error(hits, samples):
+    p = hits / samples
+    return 4 * (p * (1 - p) / samples) ** 0.5
+
+#standard error of the pi estimate of a sampling method from its running tally. For
+#stratified it is an upper bound, for qmc it is estimated from the spread of the block
+#estimates and falls back to the Monte Carlo error, which is larger, for too few blocks
+def pi_error(method, hits, samples, moment):
+    if method == "stratified":
+        return 2 * moment ** 0.5 / samples
+    blocks = -(-samples // BLOCK_SIZE)
+    if method == "qmc" and blocks >= QMC_MIN_BLOCKS:
+        spread = max(0.0, moment / BLOCK_SIZE - hits * hits / samples)
+        return 4 * (spread / (blocks - 1) / samples) ** 0.5
+    return standard_error(hits, samples)
+
+#shard accounting for requests with more shards than concurrency. The parent maps a file
+#in SHM_DIR (memory backed) of one (hits, samples, moment) int64 slot per shard, and a task runs
+#a range of shards and writes every result into its slot with pwrite, so a task returns
+#nothing to pickle and the parent sums the slots of a finished task in place
+class ShardAccounts:
+    def __init__(self, shards):
+        self.file = tempfile.NamedTemporaryFile(prefix="pi-shards-", dir=SHM_DIR)
+        self.path = self.file.name
+        os.ftruncate(self.file.fileno(), shards * SHARD_SLOT.size)
+        self.map = mmap.mmap(self.file.fileno(), shards * SHARD_SLOT.size, access=mmap.ACCESS_READ)
+
+    #(hits, samples, moment) of the shards [first, last)
+    def total(self, first, last):
+        view = memoryview(self.map)[first * SHARD_SLOT.size:last * SHARD_SLOT.size].cast("q")
+        try:
+            return sum(view[0::3]), sum(view[1::3]), sum(view[2::3])
+        finally:
+            view.release()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+#yields (hits, samples, shards, moment) of every task as it finishes, at least `concurrency`
+#tasks of up to SHARDS_PER_TASK consecutive shards
+def run_accounted_shards(estimator, seed, simulations, concurrency, shards, start=0):
+    shards = split_shards(simulations, shards, start)
+    tasks = min(len(shards), max(concurrency, -(-len(shards) // SHARDS_PER_TASK)))
+    per_task, extra = divmod(len(shards), tasks)
+    ranges, first = [], 0
+    for i in range(tasks):
+        ranges.append((first, first + per_task + (1 if i < extra else 0)))
+        first = ranges[-1][1]
+
+    profiler = profiles.current()
+    interval = profiler.interval if profiler is not None else None
+    accounts = ShardAccounts(len(shards))
+    set = get_pool().submit([(account_shards, estimator, accounts.path, seed, first, shards[first:last], interval) for first, last in ranges])
+    bounds = dict(zip(set, ranges))
     try:
-        float(n)
-        return True
-    except ValueError:
-        return False
+        for se in as_completed(set):
+            stacks = se.result()
+            if stacks is not None:
+                profiler.add(stacks)
+            first, last = bounds[se]
+            hits, samples, moment = accounts.total(first, last)
+            yield hits, samples, last - first, moment
+    finally:
+        for se in set:
+            se.cancel()
+        wait(set)   #the running tasks still write to the file
+        accounts.close()
+
+#yields (hits, samples, 1, moment) of every shard as it finishes, closing the generator
+#cancels the shards that have not been handed to a process yet
+def run_shards(estimator, seed, simulations, concurrency, start=0, shards=None):
+    if shards is not None and shards > concurrency:
+        yield from run_accounted_shards(estimator, seed, simulations, concurrency, shards, start)
+        return
+    shards = split_shards(simulations, concurrency, start)
+    profiler = profiles.current()
+    if profiler is None:
+        tasks = [(estimator, n, seed, block) for n, block in shards]
+    else:   #every shard samples its own stacks, merged into the profile of the request
+        tasks = [(profile_shard, estimator, profiler.interval, n, seed, block) for n, block in shards]
+    set = get_pool().submit(tasks)
+    samples = {se: n for se, (n, _) in zip(set, shards)}
+    try:
+        for se in as_completed(set):
+            value = se.result()
+            if profiler is not None:
+                value, stacks = value
+                profiler.add(stacks)
+            hits, moment = shard_tally(value)
+            yield hits, samples[se], 1, moment
+    finally:
+        for se in set:
+            se.cancel()
+
+#yields the running (hits, samples, shards, moment) of a /pi job. In precision mode the shards
+#run in rounds and it stops as soon as the standard error meets the target, the next round
+#is sized from the current error and throughput
+def pi_progress(job, start_time):
+    method, seed, concurrency = job["method"], job["seed"], job["concurrency"]
+    estimator = ESTIMATORS[method][job["engine"]]
+    simulations, target_error = job["simulations"], job["target_error"]
+    hits = samples = shards = moment = 0
+    compute_time = 0
+    while samples < simulations:
+        now = timeit.default_timer()
+        if target_error is None:
+            stop = simulations
+        else:
+            deadline = start_time + job["time_budget"]
+            if now >= deadline:
+                break
+            if samples == 0:
+                size = concurrency * BLOCK_SIZE
+            else:
+                error = pi_error(method, hits, samples, moment)
+                if error <= target_error:
+                    break
+                needed = samples * (error / target_error) ** 2 - samples
+                affordable = samples / compute_time * (deadline - now)
+                size = min(max(needed, BLOCK_SIZE), 4 * samples, affordable)
+            size = max(BLOCK_SIZE, -(-int(size) // BLOCK_SIZE) * BLOCK_SIZE)
+            stop = min(samples + size, simulations)
+        for count, n, done, m in run_shards(estimator, seed, stop, concurrency, samples, job["shards"]):
+            hits += count
+            samples += n
+            shards += done
+            moment += m
+            yield hits, samples, shards, moment
+        compute_time += timeit.default_timer() - now
+
+def run_pi(job, start_time):
+    hits = samples = shards = moment = 0
+    for hits, samples, shards, moment in pi_progress(job, start_time):
+        pass
+    return pi_result(job, hits, samples, shards, moment, start_time)
+
+#error_bound is the half width of the 95% confidence interval, `shards` is the number
+#of shards that ran, summed over the rounds of the precision mode
+def pi_result(job, hits, samples, shards, moment, start_time):
+    pi_estimate = hits / samples * 4
+    error = pi_error(job["method"], hits, samples, moment)
+    end_time = timeit.default_timer()
+    result = {"simulations": job["simulations"], "concurrency": job["concurrency"], "method": job["method"], "engine": job["engine"], "seed": job["seed"],
+              "pi": pi_estimate, "samples": samples, "standard_error": error, "error_bound": Z_95 * error,
+              "confidence_interval": [pi_estimate - Z_95 * error, pi_estimate + Z_95 * error],
+              "execution_time": end_time-start_time}
+    if job["shards"] is not None:
+        result["shards"] = shards
+    if job["target_error"] is not None:
+        result["target_error"] = job["target_error"]
+        result["target_met"] = error <= job["target_error"]
+    return result
+
+#the first `digits` decimals of pi, exact apart from a run of 9s past the guard digits
+def run_series(job, start_time):
+    digits, concurrency = job["digits"], job["concurrency"]
+    terms = int(digits / 14.18) + 2
+    bounds = [terms * i // concurrency for i in range(concurrency + 1)]
+    set = get_pool().submit([(chudnovsky_terms, a, b) for a, b in zip(bounds, bounds[1:]) if a < b])
+    try:
+        p, q, t = set[0].result()
+        for se in set[1:]:
+            p, q, t = merge_terms((p, q, t), se.result())
+    finally:
+        for se in set:
+            se.cancel()
+    one = 10 ** (digits + SERIES_GUARD_DIGITS)
+    pi = q * 426880 * math.isqrt(10005 * one * one) // t // 10 ** SERIES_GUARD_DIGITS
+    text = str(decimal.Decimal(pi))     #str(int) is limited to 4300 digits
+    pi_digits = text[0] + "." + text[1:]
+    return {"method": "series", "digits": digits, "concurrency": concurrency, "terms": terms, "pi": float(pi_digits[:20]),
+            "pi_digits": pi_digits, "error_bound": f"1e-{digits}", "execution_time": timeit.default_timer()-start_time}
+
+def new_seed():
+    return secrets.randbits(63)
+
+#the workers are forked from a forkserver, a clean process started once that imports
+#pi_kernel (and numpy) before forking, instead of forking the threads and sockets of the
+#web server or starting every worker from scratch like spawn
+def get_context():
+    context = multiprocessing.get_context(POOL_START_METHOD)
+    if POOL_START_METHOD == "forkserver":
+        context.set_forkserver_preload(POOL_PRELOAD)
+    return context
+
+#app scoped process pool, shards of all requests are queued per request and
+#handed to the processes round robin so one big request cannot starve the others
+class WorkerPool:
+    def __init__(self, size):
+        self.size = size
+        self.executor = None
+        self.dispatcher = None
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()     #request key -> deque of (future, fn, args, queued at)
+        self.running = 0
+        self.closed = False
+
+    def start(self):
+        with self.cond:
+            if self.executor is not None:
+                return self
+            start_time = timeit.default_timer()
+            self.executor = ProcessPoolExecutor(max_workers=self.size, mp_context=get_context())
+            self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            self.dispatcher.start()
+        wait([self.executor.submit(warm_up) for _ in range(self.size)])   #pre-warm all processes
+        metrics.observe("pi_stage_seconds", timeit.default_timer() - start_time, stage="pool_start")
+        return self
+
+    @metrics.timed("pool_submit")
+    def submit(self, tasks):
+        now = timeit.default_timer()
+        queue = deque((Future(), fn, args, now) for fn, *args in tasks)
+        futures = [future for future, _, _, _ in queue]
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("worker pool is shut down")
+            if queue:
+                self.queues[object()] = queue
+                self.cond.notify()
+        return futures
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                while not self.closed and (not self.queues or self.running >= self.size):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                key, queue = self.queues.popitem(last=False)
+                future, fn, args, queued_at = queue.popleft()
+                if queue:   #back of the line, the next request gets the next free process
+                    self.queues[key] = queue
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running += 1
+            now = timeit.default_timer()
+            metrics.observe("pi_stage_seconds", now - queued_at, stage="pool_queue_wait")
+            try:
+                self.executor.submit(fn, *args).add_done_callback(partial(self._done, future, now))
+            except Exception as e:
+                self._release()
+                future.set_exception(e)
+
+    def _release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+    def _done(self, future, started_at, inner):
+        self._release()
+        metrics.observe("pi_stage_seconds", timeit.default_timer() - started_at, stage="shard_compute")
+        if inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
+
+    def shutdown(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            for queue in self.queues.values():
+                for future, _, _, _ in queue:
+                    future.cancel()
+            self.queues.clear()
+            self.cond.notify_all()
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def queue_depth(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+pool = WorkerPool(POOL_SIZE)
+atexit.register(pool.shutdown)
+metrics.gauge("pi_pool_queue_depth", pool.queue_depth)
+metrics.gauge("pi_pool_running", lambda: pool.running)
+
+def get_pool():
+    return pool.start()
+
+#LRU cache of results with a TTL per entry and a cap on the size of the cached JSON,
+#identical requests that arrive while the first one is computing wait for its result
+class ResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    #key -> (expires, size, value)
+        self.inflight = {}              #key -> Future of the computation
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    def get_or_compute(self, key, ttl, compute):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > timeit.default_timer():
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[2], "hit"
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                self.counters["misses"] += 1
+                future = self.inflight[key] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        if not owner:
+            return future.result(), "coalesced"
+        try:
+            value = compute()
+        except Exception as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+            self._put(key, value, ttl)
+        future.set_result(value)
+        return value, "miss"
+
+    def _put(self, key, value, ttl):
+        now = timeit.default_timer()
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        for old in [old for old, entry in self.entries.items() if entry[0] <= now]:
+            self.size -= self.entries.pop(old)[1]
+            self.counters["evictions"] += 1
+        self.entries[key] = (now + ttl, size, value)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.size -= self.entries.popitem(last=False)[1][1]
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "entries": len(self.entries), "bytes": self.size}
+
+result_cache = ResultCache(CACHE_MAX_BYTES)
+
+#R2
+PI_REPLY = re.compile(r"[0-9]+\.[0-9]+")
+
+def is_float(n):    #check the string is/isnot a valid reply, no sign, exponent, nan or inf
+    return PI_REPLY.fullmatch(n) is not None
+
+#the legacy server corrupts a reply by replacing one character with a letter. Every
+#digit (or the point) is tried in its place, and the reply is recovered when all the
+#candidates close to the other replies agree within LEGACY_RECOVER_TOLERANCE, which is
+#the case when a later decimal was hit
+def recover_pi(reply, reference):
+    bad = [i for i, ch in enumerate(reply) if ch not in "0123456789."]
+    if len(bad) != 1:
+        return None
+    pos = bad[0]
+    fills = "0123456789" if "." in reply else "0123456789."
+    candidates = [float(c) for c in (reply[:pos] + ch + reply[pos+1:] for ch in fills) if is_float(c)]
+    candidates = [c for c in candidates if abs(c - reference) <= 2 * LEGACY_MAX_ERROR]
+    if not candidates or max(candidates) - min(candidates) > LEGACY_RECOVER_TOLERANCE:
+        return None
+    return sum(candidates) / len(candidates)
+
+#returns (valid values, recovered values) of the replies, None is a failed request
+@metrics.timed("legacy_parse")
+def parse_replies(replies, recover=False):
+    values = [float(n) for n in replies if n is not None and is_float(n)]
+    recovered = []
+    if recover and values:
+        reference = median(values)
+        for n in replies:
+            if n is not None and not is_float(n):
+                value = recover_pi(n, reference)
+                if value is not None:
+                    recovered.append(value)
+    return values, recovered
+
+def aggregate_pi(values, recovered, estimator="mean"):
+    results = sorted(values + recovered)
+    if not results:
+        return 0
+    if estimator == "median":
+        return median(results)
+    if estimator == "trimmed":
+        cut = int(len(results) * LEGACY_TRIM)
+        return sum(results[cut:len(results)-cut]) / (len(results) - 2 * cut)
+    if estimator == "consensus":    #recovered values count half, values far from the median are dropped
+        center = median(results)
+        weighted = [(value, weight) for group, weight in [(values, 1), (recovered, 0.5)] for value in group
+                    if abs(value - center) <= LEGACY_MAX_ERROR]
+        if not weighted:    #no two values agree, the median is the best guess
+            return center
+        return sum(value * weight for value, weight in weighted) / sum(weight for _, weight in weighted)
+    return sum(results) / len(results)
+
+#all legacy requests run on one asyncio loop in a background thread, a semaphore limits
+#the requests in flight to the legacy server across all HTTP requests
+class LegacyDatagram(asyncio.DatagramProtocol):
+    def __init__(self, reply):
+        self.reply = reply
+
+    def datagram_received(self, data, addr):
+        if not self.reply.done():
+            self.reply.set_result(data)
+
+    def error_received(self, exc):
+        if not self.reply.done():
+            self.reply.set_exception(exc)
+
+#kept-alive connection in the pipeline mode of the legacy server, requests are newline
+#framed and answered in order, so the replies are matched with a FIFO of futures
+class LegacyConnection:
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.waiting = deque()
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self._read())
+
+    def request(self):
+        if self.closed:
+            raise ConnectionError("legacy connection closed")
+        reply = asyncio.get_running_loop().create_future()
+        self.waiting.append(reply)
+        self.writer.write(b"\n")
+        return reply
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line.endswith(b"\n"):
+                    break
+                reply = self.waiting.popleft()
+                if not reply.done():    #a cancelled request still gets its reply, it is dropped here
+                    reply.set_result(line[:-1].decode())
+        except Exception:
+            pass
+        finally:
+            self.closed = True
+            for reply in self.waiting:
+                if not reply.done():
+                    reply.set_exception(ConnectionError("legacy connection closed"))
+            self.writer.close()
+
+    def close(self):
+        self.reader_task.cancel()
+
+#a new request goes to the connection with the fewest replies outstanding, a new
+#connection is only opened when all of them are busy and the pool is not full.
+#Connections being opened count against the size, so a burst cannot open more
+class LegacyConnectionPool:
+    def __init__(self, host, port, size):
+        self.host, self.port = host, port
+        self.size = size
+        self.connections = []
+        self.opening = 0
+        self.opened = asyncio.Condition()
+
+    async def get(self):
+        while True:
+            self.connections = [conn for conn in self.connections if not conn.closed]
+            conn = min(self.connections, key=lambda conn: len(conn.waiting), default=None)
+            if (conn is None or conn.waiting) and len(self.connections) + self.opening < self.size:
+                conn = await self._open()
+            if conn is not None:
+                return conn
+            async with self.opened:     #the pool is full of connections still being opened
+                await self.opened.wait()
+
+    async def _open(self):
+        self.opening += 1    #reserved before the first await
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            writer.write(LEGACY_PIPELINE_HEADER)
+            conn = LegacyConnection(reader, writer)
+            self.connections.append(conn)
+            return conn
+        finally:
+            self.opening -= 1
+            async with self.opened:
+                self.opened.notify_all()
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+class LegacyClient:
+    def __init__(self, host, port, max_inflight, timeout, deadline, retries, hedge_delay, keepalive=False, pool_size=LEGACY_POOL_SIZE):
+        self.host, self.port = host, port
+        self.connections = LegacyConnectionPool(host, port, pool_size) if keepalive else None
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge_delay = hedge_delay
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return self
+
+    def fetch(self, protocol, count):
+        return asyncio.run_coroutine_threadsafe(self.fetch_many(protocol, count), self.loop).result()
+
+    async def fetch_many(self, protocol, count):
+        return await asyncio.gather(*(self.fetch_one(protocol) for _ in range(count)))
+
+    #returns the reply or None when every attempt failed before the deadline
+    async def fetch_one(self, protocol):
+        try:
+            return await asyncio.wait_for(self._hedged(protocol), self.deadline)
+        except asyncio.TimeoutError:
+            return None
+
+    #a failed attempt is retried at once, a slow one gets a hedged request next to it,
+    #the first reply wins and the other attempts are cancelled. The hedge delay of an
+    #attempt only starts once it holds the semaphore and has sent its request, so time
+    #spent waiting for a slot does not trigger more attempts
+    async def _hedged(self, protocol):
+        loop = asyncio.get_running_loop()
+        pending = set()
+        tries = 0
+        launch = True
+        try:
+            while True:
+                if launch and tries <= self.retries:
+                    sent = loop.create_future()
+                    pending.add(asyncio.ensure_future(self._attempt(protocol, sent)))
+                    tries += 1
+                if not pending:
+                    return None
+                if not sent.done():
+                    done, _ = await asyncio.wait(pending | {sent}, return_when=asyncio.FIRST_COMPLETED)
+                    launch = False
+                else:
+                    done, _ = await asyncio.wait(pending, timeout=self.hedge_delay if tries <= self.retries else None,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    launch = True
+                for task in done & pending:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    launch = True
+        finally:
+            for task in pending:
+                task.cancel()
+
+    #`sent` is set once the request is on its way
+    async def _attempt(self, protocol, sent):
+        request = self._tcp if protocol == "tcp" else self._udp
+        async with self.semaphore:
+            self.inflight += 1
+            start = timeit.default_timer()
+            try:
+                reply = await asyncio.wait_for(request(sent), self.timeout)
+            except BaseException as e:
+                result = {asyncio.TimeoutError: "timeout", asyncio.CancelledError: "cancelled"}.get(type(e), "error")
+                metrics.inc("legacy_attempts_total", protocol=protocol, result=result)
+                raise
+            finally:
+                self.inflight -= 1
+            metrics.observe("pi_stage_seconds", timeit.default_timer() - start, stage="legacy_round_trip")
+            metrics.inc("legacy_attempts_total", protocol=protocol, result="ok")
+            return reply
+
+    async def _tcp(self, sent):
+        if self.connections is not None:
+            reply = (await self.connections.get()).request()
+            sent.set_result(None)
+            return await reply
+        sent.set_result(None)   #the legacy server answers a new connection, the connect is the request
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            return (await reader.read()).decode()
+        finally:
+            writer.close()
+
+    #every attempt has its own connected socket, so a reply can only be matched with
+    #the request sent from it and a late reply to a cancelled attempt is dropped
+    async def _udp(self, sent):
+        loop = asyncio.get_running_loop()
+        reply = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: LegacyDatagram(reply), remote_addr=(self.host, self.port))
+        try:
+            transport.sendto(b"pi")  #asyncio silently drops empty datagrams, the legacy server ignores the payload
+            sent.set_result(None)
+            return (await reply).decode()
+        finally:
+            transport.close()
+
+    def close(self):
+        if self.loop is not None:
+            if self.connections is not None:
+                self.loop.call_soon_threadsafe(self.connections.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+legacy_client = LegacyClient(LEGACY_HOST, LEGACY_PORT, LEGACY_MAX_INFLIGHT, LEGACY_TIMEOUT, LEGACY_DEADLINE, LEGACY_RETRIES, LEGACY_HEDGE_DELAY,
+                             LEGACY_KEEPALIVE, LEGACY_POOL_SIZE)
+atexit.register(legacy_client.close)
+metrics.gauge("legacy_inflight_requests", lambda: legacy_client.inflight)
+
+def get_legacy_client():
+    return legacy_client.start()
 
 def legacy_pi_tcp():
-    global socket, LEGACY_HOST, LEGACY_PORT    
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((LEGACY_HOST, LEGACY_PORT))
-        s.sendall(b"") 
-        pi = s.recv(1024)
-    return pi.decode()
+    return get_legacy_client().fetch("tcp", 1)[0]
 
 def legacy_pi_udp():
-    global socket, LEGACY_HOST, LEGACY_PORT
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        s.sendto(b"", (LEGACY_HOST, LEGACY_PORT))
-        pi, addr = s.recvfrom(1024)
-    return pi.decode()
+    return get_legacy_client().fetch("udp", 1)[0]
 
 #R3, R5
-def get_statistics():
-    stats = {}
-    if os.path.exists(STATS_FILE):
-        with open(STATS_FILE, 'r') as f:
-            for line in f:
-                username, count = line.strip().split()
-                stats[username] = int(count)
-    else:   #create file if have not file
-        open(STATS_FILE, 'w').close()
-    return stats
-
-def save_statistics(username):
-    with lock:
-        stats = get_statistics()
-
-        if username in stats:
-            stats[username] += 1
-        else:
-            stats[username] = 1
+#the counters are kept in memory and flushed every STATS_FLUSH_INTERVAL seconds into a
+#SQLite database in WAL mode, which is safe to share between worker processes and
+#recovers by itself after a crash. Every flush also exports STATS_FILE, written to a
+#temporary file and renamed so readers never see a half written file
+class StatisticsStore:
+    def __init__(self, db_path, export_path, flush_interval):
+        self.db_path = db_path
+        self.export_path = export_path
+        self.flush_interval = flush_interval
+        self.pending = Counter()
+        self.lock = threading.Lock()        #guards pending
+        self.db_lock = threading.Lock()     #guards db
+        self.db = None
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def start(self):
+        with self.db_lock:
+            if self.db is not None:
+                return self
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS statistics (username TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("SELECT COUNT(*) FROM statistics").fetchone()[0] == 0:
+                db.executemany("INSERT INTO statistics VALUES (?, ?)", self._read_export())    #first start, import the old file
+            db.execute("COMMIT")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")   #compact the log left by the last run
+            self.db = db
+        if self.flush_interval > 0:
+            self.flusher = threading.Thread(target=self._run, daemon=True)
+            self.flusher.start()
+        return self
 
-    with open(STATS_FILE, 'w') as f:
-        for username, count in stats.items():
-            f.write(f"{username} {count}\n")
+    def _read_export(self):
+        stats = {}
+        if os.path.exists(self.export_path):
+            with open(self.export_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        username, count = line.strip().split()
+                        stats[username] = int(count)
+        return list(stats.items())
 
-    return stats
+    def increment(self, username, count=1):
+        with self.lock:
+            self.pending[username] += count
+        if self.flush_interval <= 0:
+            self.flush()
+
+    #writes the pending counts to the database and then exports the text file outside of
+    #the write transaction. Only the flusher, close() and the write through mode flush
+    @metrics.timed("statistics_flush")
+    def flush(self):
+        with self.db_lock:
+            with self.lock:     #swapped under db_lock, so snapshot() never misses them
+                pending, self.pending = self.pending, Counter()
+            if not pending:
+                return
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT INTO statistics VALUES (?, ?) ON CONFLICT(username) DO UPDATE SET count = count + excluded.count",
+                                    pending.items())
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                with self.lock:
+                    self.pending.update(pending)
+                raise
+            rows = self.db.execute("SELECT username, count FROM statistics ORDER BY rowid").fetchall()
+        self._export(rows)
+
+    def _export(self, rows):
+        tmp_path = f"{self.export_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            for username, count in rows:
+                f.write(f"{username} {count}\n")
+        os.replace(tmp_path, self.export_path)
+
+    #the database plus the counts of this process not flushed yet, nothing is written
+    def snapshot(self):
+        with self.db_lock:
+            stats = dict(self.db.execute("SELECT username, count FROM statistics ORDER BY rowid").fetchall())
+            with self.lock:
+                pending = Counter(self.pending)
+        for username, count in pending.items():
+            stats[username] = stats.get(username, 0) + count
+        return stats
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass    #kept in pending, retried on the next flush
+
+    def close(self):
+        self.stopped.set()
+        if self.db is not None:
+            self.flush()
+            with self.db_lock:
+                self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.db.close()
+                self.db = None
+
+stats_store = StatisticsStore(STATS_DB, STATS_FILE, STATS_FLUSH_INTERVAL)
+atexit.register(stats_store.close)
+
+def get_stats_store():
+    return stats_store.start()
+
+@metrics.timed("statistics_io")
+def get_statistics():
+    return get_stats_store().snapshot()
+
+@metrics.timed("statistics_io")
+def save_statistics(username, count=1):
+    get_stats_store().increment(username, count)
 
 #R4
+#the credentials come from a pluggable store with a verify(username, password) method,
+#the original rule (4 digit username and password "<username>-pw") or a JSON file of
+#password hashes. Passwords are always compared in constant time
+class RuleCredentials:
+    def verify(self, username, password):
+        if len(username) != 4 or not username.isdigit():
+            return False
+        return hmac.compare_digest(password.encode(), f"{username}-pw".encode())
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS, salt=None):
+    salt = salt or secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+def check_password(password, stored):
+    try:
+        algorithm, iterations, salt, digest = stored.split("$")
+        if algorithm != "pbkdf2_sha256":
+            return False
+        expected = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+        return hmac.compare_digest(expected, bytes.fromhex(digest))
+    except (ValueError, AttributeError):
+        return False
+
+#{"username": "pbkdf2_sha256$iterations$salt$hash"}, reloaded when the file changes
+class FileCredentials:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.missing = hash_password(secrets.token_hex(16))    #unknown users take as long as known ones
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.path) as f:
+                    self.hashes = json.load(f)
+                self.mtime = mtime
+            return self.hashes
+
+    def verify(self, username, password):
+        hashes = self._load()
+        return check_password(password, hashes.get(username, self.missing)) and username in hashes
+
+#remembers the result of a verification for AUTH_CACHE_TTL seconds, the key is a keyed
+#hash of the credentials so the cache never holds a password
+class Authenticator:
+    def __init__(self, store, ttl, max_entries):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.secret = secrets.token_bytes(32)
+        self.entries = OrderedDict()    #key -> (expires, valid)
+        self.lock = threading.Lock()
+
+    def verify(self, username, password):
+        key = hmac.new(self.secret, f"{len(username)}:{username}{password}".encode(), "sha256").digest()
+        now = timeit.default_timer()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        valid = self.store.verify(username, password)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, valid)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return valid
+
+authenticator = Authenticator(FileCredentials(CREDENTIALS_FILE) if CREDENTIALS_FILE else RuleCredentials(), AUTH_CACHE_TTL, AUTH_CACHE_SIZE)
+
+@metrics.timed("auth")
 def is_valid_user(username, password):
-    if not username or not isinstance(username, str) or len(username) != 4 or not username.isdigit():
+    if not username or not isinstance(username, str):
         return False
-    if not password or password != f"{username}-pw":
+    if not password or not isinstance(password, str):
         return False
-    return True
+    return authenticator.verify(username, password)
+
+#one token bucket per user, `rate` tokens per second up to `capacity`. A request bigger than
+#the capacity can never be paid for and is refused, so a bucket never goes into debt
+class TokenBuckets:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}   #key -> (tokens, time of the last refill)
+        self.lock = threading.Lock()
+
+    #takes `cost` tokens, returns 0, the seconds until they are available or None when
+    #the cost is over the capacity
+    def take(self, key, cost=1):
+        if self.rate <= 0:
+            return 0
+        if cost > self.capacity:
+            return None
+        now = timeit.default_timer()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / self.rate
+
+    def refund(self, key, amount):
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.capacity, timeit.default_timer()))
+            self.buckets[key] = (min(self.capacity, tokens + amount), last)
+
+class RateLimited(Exception):
+    def __init__(self, error, retry_after):
+        super().__init__(error)
+        self.error = error
+        self.retry_after = retry_after
+
+    #no Retry-After when waiting does not help
+    def response(self):
+        if self.retry_after is None:
+            return {"error": self.error}, 429, {}
+        return {"error": self.error}, 429, {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+request_limits = TokenBuckets(RATE_LIMIT, RATE_BURST)
+simulation_quota = TokenBuckets(SIMULATIONS_PER_MINUTE / 60, SIMULATIONS_PER_MINUTE)
+
+#checked before any work reaches the worker pool, raise RateLimited (429)
+def check_rate(username):
+    wait = request_limits.take(username)
+    if wait:
+        raise RateLimited("rate limit exceeded", wait)
+
+#the simulations of a /pi request are charged up front and the ones not drawn (precision
+#mode, cache hits) are given back when it finishes. A request or batch over the whole
+#quota is refused
+def charge_simulations(username, simulations):
+    wait = simulation_quota.take(username, simulations)
+    if wait is None:
+        raise RateLimited("simulations over the quota", None)
+    if wait:
+        raise RateLimited("simulation quota exceeded", wait)
+
+def refund_simulations(username, simulations):
+    simulation_quota.refund(username, simulations)
 
 #R1
-@app.post("/pi")
+#returns (job, None) or (None, error message) for the fields of a /pi request
+def validate_pi(data):
+    simulations = data.get("simulations")
+    concurrency = data.get("concurrency", 1)
+    engine = data.get("engine", DEFAULT_ENGINE)
+    seed = data.get("seed")
+    target_error = data.get("target_error")
+    digits = data.get("digits")
+    time_budget = data.get("time_budget", TIME_BUDGET)
+    method = data.get("method", "monte_carlo")
+    use_cache = data.get("cache", True)
+
+    if not isinstance(method, str) or method not in METHODS:
+        return None, "invalid field method"
+    if not isinstance(use_cache, bool):
+        return None, "invalid field cache"
+
+    #the series computes `digits` decimals exactly, it draws no samples
+    if method == "series":
+        if digits is None:
+            return None, "missing field digits"
+        if not isinstance(digits, int) or isinstance(digits, bool) or digits < 1 or digits > SERIES_MAX_DIGITS:
+            return None, "invalid field digits"
+        if target_error is not None:
+            return None, "invalid field target_error"
+        if not isinstance(concurrency, int) or concurrency < 1 or concurrency > 8:
+            return None, "invalid field concurrency"
+        return {"method": method, "digits": digits, "concurrency": concurrency, "simulations": 0, "cached": use_cache}, None
+
+    #precision mode, simulations is optional and becomes the upper limit
+    if target_error is not None or digits is not None:
+        if target_error is not None and digits is not None:
+            return None, "invalid field digits"
+        if digits is not None:
+            if not isinstance(digits, int) or isinstance(digits, bool) or digits < 1 or digits > PRECISION_MAX_DIGITS[method]:
+                return None, "invalid field digits"
+            target_error = 0.5 * 10 ** -digits / Z_95   #95% interval within half a unit of the last digit
+        elif not isinstance(target_error, (int, float)) or isinstance(target_error, bool) or target_error <= 0:
+            return None, "invalid field target_error"
+        if not isinstance(time_budget, (int, float)) or isinstance(time_budget, bool) or time_budget <= 0 or time_budget > 600:
+            return None, "invalid field time_budget"
+        if not simulations:
+            simulations = MAX_SIMULATIONS
+
+    if not simulations:
+        return None, "missing field simulations"
+    if simulations < 100 or simulations > MAX_SIMULATIONS:
+        return None, "invalid field simulations"
+    
+    if not isinstance(concurrency, int) or concurrency < 1 or concurrency > 8:
+        return None, "invalid field concurrency"
+
+    shards = data.get("shards")
+    #the shards take whole blocks, so there are at most as many as blocks of samples
+    if shards is not None and (not isinstance(shards, int) or isinstance(shards, bool) or shards < concurrency
+                               or shards > -(-simulations // BLOCK_SIZE)):
+        return None, "invalid field shards"
+
+    if not isinstance(engine, str) or engine not in ENGINES:
+        return None, "invalid field engine"
+
+    seeded = seed is not None
+    if seed is None:
+        seed = new_seed()
+    elif not isinstance(seed, int) or isinstance(seed, bool) or seed < 0:
+        return None, "invalid field seed"
+
+    #concurrency is the number of shards, the processes are shared by all requests.
+    #Only seeded fixed size requests are deterministic and can be cached
+    return {"method": method, "simulations": simulations, "concurrency": concurrency, "shards": shards, "engine": engine, "seed": seed,
+            "target_error": target_error, "time_budget": time_budget,
+            "cached": use_cache and seeded and target_error is None}, None
+
+#runs a validated /pi request and gives back the simulations it did not draw
+def run_pi_request(username, job, start_time):
+    if job["method"] == "series":   #nothing was charged
+        run, key = run_series, ("pi", "series", job["digits"])
+    else:
+        run, key = run_pi, ("pi", job["method"], job["engine"], job["seed"], job["simulations"])
+    if job["cached"]:   #concurrency and shards do not change the result, the caller's are reported
+        result, cache = result_cache.get_or_compute(key, CACHE_TTL, lambda: run(job, start_time))
+        refund_simulations(username, job["simulations"] - (result.get("samples", 0) if cache == "miss" else 0))
+        result = {**result, "concurrency": job["concurrency"], "cache": cache, "execution_time": timeit.default_timer()-start_time}
+        result.pop("shards", None)
+        if job.get("shards") is not None:   #a cached run is never a precision run, so all the shards ran
+            result["shards"] = job["shards"]
+        return result
+    result = run(job, start_time)
+    refund_simulations(username, job["simulations"] - result.get("samples", 0))
+    return result
+
+#the route logic takes the JSON body and returns (body, status), so the Flask views
+#and the ASGI app in s12755670_asgi.py share it
+def handle_pi(data):
+    start_time = timeit.default_timer()
+    username = data.get("username")
+    password = data.get("password")
+
+    #R4
+    if not is_valid_user(username, password):
+        return {"error": "user info error"}, 401
+    else:
+        check_rate(username)
+        save_statistics(username)
+    #---
+
+    job, error = validate_pi(data)
+    if error:
+        return {"error": error}, 400
+
+    charge_simulations(username, job["simulations"])
+    return run_pi_request(username, job, start_time), 200
+
+@routes.post("/pi")
 def pi():
+    body, status = handle_pi(request.get_json())
+    return jsonify(body), status
+
+#streams one NDJSON line per finished shard and the /pi result as the last line,
+#closing the connection cancels the shards that have not started
+@routes.post("/pi/stream")
+def pi_stream():
     start_time = timeit.default_timer()
     data = request.get_json()
     username = data.get("username")
     password = data.get("password")
-    simulations = data.get("simulations")
-    concurrency = data.get("concurrency", 1)
 
     #R4
     if not is_valid_user(username, password):
         return jsonify({"error": "user info error"}), 401
     else:
+        check_rate(username)
         save_statistics(username)
     #---
 
-    if not simulations:
-        return jsonify({"error": "missing field simulations"}), 400
-    if simulations < 100 or simulations > 100000000:
-        return jsonify({"error": "invalid field simulations"}), 400
-    
-    if not isinstance(concurrency, int) or concurrency < 1 or concurrency > 8:
-        return jsonify({"error": "invalid field concurrency"}), 400
-    
+    job, error = validate_pi(data)
+    if not error and job["method"] == "series":     #has no shards to stream
+        error = "invalid field method"
+    if error:
+        return jsonify({"error": error}), 400
+    charge_simulations(username, job["simulations"])
 
-    total_count = 0
-    if concurrency > 1:
-        with ProcessPoolExecutor(max_workers=concurrency) as executor:
-            set = [executor.submit(myth_value, simulations // concurrency) for _ in range(concurrency)]
-            total_count = sum(se.result() for se in set)
-    else:
-        total_count = myth_value(simulations)
+    def generate():
+        progress = pi_progress(job, start_time)
+        hits = samples = shards = moment = 0
+        try:
+            for hits, samples, shards, moment in progress:
+                elapsed = timeit.default_timer() - start_time
+                yield json.dumps({"done": False, "shards_completed": shards, "samples": samples, "pi": hits / samples * 4,
+                                  "standard_error": pi_error(job["method"], hits, samples, moment), "throughput": samples / elapsed}) + "\n"
+        finally:
+            progress.close()
+            refund_simulations(username, job["simulations"] - samples)
+        yield json.dumps({"done": True, **pi_result(job, hits, samples, shards, moment, start_time)}) + "\n"
 
-    pi_estimate = total_count / simulations * 4
-    end_time = timeit.default_timer()
+    return Response(generate(), mimetype="application/x-ndjson")
     
-    return jsonify({"simulations": simulations, "concurrency": concurrency, "pi": pi_estimate, "execution_time": end_time-start_time})
-    
-#R2
-@app.post("/legacy_pi")
-def legacy_pi():
-    start_time = timeit.default_timer()
+#asynchronous /pi jobs, a bounded queue feeds JOB_WORKERS threads that only wait on
+#the shards in the worker pool, finished jobs are kept for JOB_TTL seconds
+class PiJob:
+    def __init__(self, username, job):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.job = job
+        self.status = "queued"
+        self.hits = self.samples = self.shards = self.moment = 0
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self.cancelled = threading.Event()
+
+    def to_json(self):
+        status = {"job_id": self.id, "status": self.status, "samples": self.samples}
+        if self.samples:
+            status["pi"] = self.hits / self.samples * 4
+        if self.error:
+            status["error"] = self.error
+        return status
+
+#status changes happen under the lock, so a job is finished and refunded exactly once.
+#The queue is a deque under the same lock, a job cancelled while queued is taken out of it
+#and frees its slot at once
+class JobStore:
+    def __init__(self, queue_size, workers, ttl):
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.workers = workers
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.threads = []
+        self.closed = False
+
+    def start(self):
+        with self.lock:
+            if not self.threads and not self.closed:
+                self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(self.workers)]
+                for thread in self.threads:
+                    thread.start()
+        return self
+
+    def submit(self, username, job):
+        self.evict()
+        pi_job = PiJob(username, job)
+        with self.lock:
+            if self.closed or len(self.queue) >= self.queue_size:
+                return None
+            self.queue.append(pi_job)
+            self.jobs[pi_job.id] = pi_job
+            self.ready.notify()
+        return pi_job
+
+    def get(self, job_id, username):
+        self.evict()
+        with self.lock:
+            pi_job = self.jobs.get(job_id)
+        if pi_job is None or pi_job.username != username:
+            return None
+        return pi_job
+
+    def cancel(self, pi_job):
+        pi_job.cancelled.set()
+        with self.lock:
+            if pi_job.status != "queued":   #a running job is finished by its worker
+                return
+            self.queue.remove(pi_job)
+        self._finish(pi_job, "cancelled")
+
+    def evict(self):
+        now = timeit.default_timer()
+        with self.lock:
+            for job_id in [job_id for job_id, pi_job in self.jobs.items() if pi_job.finished_at and now - pi_job.finished_at > self.ttl]:
+                del self.jobs[job_id]
+
+    def _finish(self, pi_job, status):
+        with self.lock:
+            if pi_job.finished_at is not None:
+                return
+            pi_job.status = status
+            pi_job.finished_at = timeit.default_timer()
+        refund_simulations(pi_job.username, pi_job.job["simulations"] - pi_job.samples)
+
+    def _run(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if not self.queue:      #closed and drained
+                    return
+                pi_job = self.queue.popleft()
+                pi_job.status = "running"
+            start_time = timeit.default_timer()
+            progress = pi_progress(pi_job.job, start_time)
+            try:
+                for hits, samples, shards, moment in progress:
+                    pi_job.hits, pi_job.samples, pi_job.shards, pi_job.moment = hits, samples, shards, moment
+                    if pi_job.cancelled.is_set():
+                        break
+            except Exception as e:
+                pi_job.error = str(e)
+                self._finish(pi_job, "failed")
+                continue
+            finally:
+                progress.close()
+            if pi_job.cancelled.is_set():
+                self._finish(pi_job, "cancelled")
+            else:
+                pi_job.result = pi_result(pi_job.job, pi_job.hits, pi_job.samples, pi_job.shards, pi_job.moment, start_time)
+                self._finish(pi_job, "done")
+
+    #stops taking jobs, the workers finish the queued ones and are waited for up to `timeout` seconds
+    def shutdown(self, timeout=0):
+        with self.lock:
+            self.closed = True
+            threads = self.threads
+            self.ready.notify_all()
+        deadline = timeit.default_timer() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - timeit.default_timer()))
+
+job_store = JobStore(JOB_QUEUE_SIZE, JOB_WORKERS, JOB_TTL)
+atexit.register(job_store.shutdown)
+metrics.gauge("pi_job_queue_depth", lambda: len(job_store.queue))
+
+@routes.post("/pi/jobs")
+def submit_pi_job():
     data = request.get_json()
     username = data.get("username")
     password = data.get("password")
-    protocol = data.get("protocol")
-    concurrency = data.get("concurrency", 1)
 
     #R4
     if not is_valid_user(username, password):
         return jsonify({"error": "user info error"}), 401
     else:
+        check_rate(username)
         save_statistics(username)
     #---
 
+    job, error = validate_pi(data)
+    if not error and job["method"] == "series":     #runs in one go, send it to /pi
+        error = "invalid field method"
+    if error:
+        return jsonify({"error": error}), 400
+
+    charge_simulations(username, job["simulations"])
+    pi_job = job_store.start().submit(username, job)
+    if pi_job is None:
+        refund_simulations(username, job["simulations"])
+        return jsonify({"error": "job queue full"}), 429, {"Retry-After": str(JOB_RETRY_AFTER)}
+    return jsonify(pi_job.to_json()), 202
+
+@routes.post("/pi/jobs/<job_id>")
+@routes.post("/pi/jobs/<job_id>/<action>")
+def pi_job(job_id, action="status"):
+    data = request.get_json()
+    username = data.get("username")
+    password = data.get("password")
+
+    #R4
+    if not is_valid_user(username, password):
+        return jsonify({"error": "user info error"}), 401
+    #---
+
+    if action not in ["status", "result", "cancel"]:
+        return jsonify({"error": "invalid action"}), 404
+    pi_job = job_store.get(job_id, username)
+    if pi_job is None:
+        return jsonify({"error": "job not found"}), 404
+
+    if action == "cancel":
+        job_store.cancel(pi_job)
+    elif action == "result":
+        if pi_job.status == "done":
+            return jsonify(pi_job.result)
+        if pi_job.status in ["queued", "running"]:
+            return jsonify(pi_job.to_json()), 202
+        return jsonify(pi_job.to_json()), 409
+    return jsonify(pi_job.to_json())
+
+#R2
+#returns (request, None) or (None, error message) for the fields of a /legacy_pi request
+def validate_legacy_pi(data):
+    protocol = data.get("protocol")
+    concurrency = data.get("concurrency", 1)
+
     if not protocol:
-        return jsonify({"error": "missing field protocol"}), 400
+        return None, "missing field protocol"
     elif not isinstance(protocol, str) or (protocol not in ['tcp', 'udp']):
-        return jsonify({"error": "invalid field protocol"}), 400
+        return None, "invalid field protocol"
     
-    if not isinstance(concurrency, int) or concurrency < 1 or concurrency > 8:
-        return jsonify({"error": "invalid field concurrency"}), 400
-
-    pi = 0
-    with ThreadPoolExecutor(max_workers=concurrency) as executor:
-        results = []
-        if protocol == "tcp": 
-            set = [executor.submit(legacy_pi_tcp) for _ in range(concurrency)]
-        elif protocol == "udp": 
-            set = [executor.submit(legacy_pi_udp) for _ in range(concurrency)]
-        
-        for n in set:
-            n = n.result()
-            if(is_float(n)):
-                results.append(float(n))
-
-        results_count = len(results)
-        pi = sum(results) / results_count if results_count > 0 else 0
+    if not isinstance(concurrency, int) or concurrency < 1 or concurrency > LEGACY_MAX_CONCURRENCY:
+        return None, "invalid field concurrency"
 
+    estimator = data.get("estimator", "mean")
+    if not isinstance(estimator, str) or estimator not in LEGACY_ESTIMATORS:
+        return None, "invalid field estimator"
+
+    recover = data.get("recover", False)
+    if not isinstance(recover, bool):
+        return None, "invalid field recover"
+
+    target_valid = data.get("target_valid")
+    if target_valid is not None and (not isinstance(target_valid, int) or isinstance(target_valid, bool)
+                                     or target_valid < 1 or target_valid > concurrency * LEGACY_MAX_ROUNDS):
+        return None, "invalid field target_valid"
+
+    use_cache = data.get("cache", True)
+    if not isinstance(use_cache, bool):
+        return None, "invalid field cache"
+
+    return {"protocol": protocol, "concurrency": concurrency, "estimator": estimator, "recover": recover,
+            "target_valid": target_valid, "cached": use_cache and LEGACY_CACHE_TTL > 0}, None
+
+def run_legacy_pi(legacy, start_time):
+    protocol, concurrency = legacy["protocol"], legacy["concurrency"]
+    args = (protocol, concurrency, legacy["estimator"], legacy["recover"], legacy["target_valid"])
+    if legacy["cached"]:
+        result, cache = result_cache.get_or_compute(("legacy_pi", *args), LEGACY_CACHE_TTL, lambda: fetch_legacy_pi(*args))
+    else:
+        result, cache = fetch_legacy_pi(*args), None
     end_time = timeit.default_timer()
-    return jsonify({"protocol": protocol, "concurrency": concurrency, "num_valid_results": results_count, "pi": pi, "execution_time": end_time-start_time})
+    response = {"protocol": protocol, "concurrency": concurrency, **result, "execution_time": end_time-start_time}
+    if cache:
+        response["cache"] = cache
+    return response
+
+def handle_legacy_pi(data):
+    start_time = timeit.default_timer()
+    username = data.get("username")
+    password = data.get("password")
+
+    #R4
+    if not is_valid_user(username, password):
+        return {"error": "user info error"}, 401
+    else:
+        check_rate(username)
+        save_statistics(username)
+    #---
+
+    legacy, error = validate_legacy_pi(data)
+    if error:
+        return {"error": error}, 400
+    return run_legacy_pi(legacy, start_time), 200
+
+@routes.post("/legacy_pi")
+def legacy_pi():
+    body, status = handle_legacy_pi(request.get_json())
+    return jsonify(body), status
+
+#with target_valid, rounds of `concurrency` requests are sent until enough replies are valid
+def fetch_legacy_pi(protocol, concurrency, estimator="mean", recover=False, target_valid=None):
+    replies = []
+    for _ in range(LEGACY_MAX_ROUNDS if target_valid else 1):
+        replies += get_legacy_client().fetch(protocol, concurrency)
+        values, recovered = parse_replies(replies, recover)
+        if not target_valid or len(values) + len(recovered) >= target_valid:
+            break
+    return {"num_valid_results": len(values) + len(recovered), "num_recovered": len(recovered), "num_requests": len(replies),
+            "estimator": estimator, "pi": aggregate_pi(values, recovered, estimator)}
+
+@routes.post("/cache")
+def cache():
+    data = request.get_json()
+    username = data.get("username")
+    password = data.get("password")
+
+    #R4
+    if not is_valid_user(username, password):
+        return jsonify({"error": "user info error"}), 401
+    #---
+
+    return jsonify(result_cache.stats())
 
 #R3
-@app.post("/statistics")
+def handle_statistics(data):
+    username = data.get("username")
+    password = data.get("password")
+
+    #R4
+    if not is_valid_user(username, password):
+        return {"error": "user info error"}, 401
+    #---
+
+    check_rate(username)
+    save_statistics(username)
+    result = get_statistics()
+    return result, 200
+
+@routes.post("/statistics")
 def statistics():
-    get_json = request.get_json()
-    username = get_json.get("username")
-    password = get_json.get("password")
+    body, status = handle_statistics(request.get_json())
+    return jsonify(body), status
+
+#a batch of /pi and /legacy_pi requests: {"items": [{"type": "pi", "simulations": ...}, {"type": "legacy_pi", ...}]}.
+#All items are validated before any runs, then they run together, the /pi shards of all
+#items are queued at once on the shared worker pool
+BATCH_TYPES = {"pi": validate_pi, "legacy_pi": validate_legacy_pi}
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+#returns ([(type, request)], None) or (None, error body)
+def validate_batch(data):
+    items = data.get("items")
+    if not items:
+        return None, {"error": "missing field items"}
+    if not isinstance(items, list) or len(items) > BATCH_MAX_ITEMS:
+        return None, {"error": "invalid field items"}
+    batch = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            return None, {"error": "invalid field items", "item": i}
+        kind = item.get("type", "pi")
+        if not isinstance(kind, str) or kind not in BATCH_TYPES:
+            return None, {"error": "invalid field type", "item": i}
+        spec, error = BATCH_TYPES[kind](item)
+        if error:
+            return None, {"error": error, "item": i}
+        batch.append((kind, spec))
+    return batch, None
+
+#auth, limits, statistics and validation of /batch and /batch/stream, returns the
+#futures of the items or (None, (error body, status))
+def start_batch(data):
+    username = data.get("username")
+    password = data.get("password")
 
     #R4
     if not is_valid_user(username, password):
-        return jsonify({"error": "user info error"}), 401
+        return None, ({"error": "user info error"}, 401)
+    else:
+        check_rate(username)
+        save_statistics(username)
     #---
 
-    result = save_statistics(username)
-    return jsonify(result)
+    batch, error = validate_batch(data)
+    if error:
+        return None, (error, 400)
+    if BATCH_STATISTICS == "item" and len(batch) > 1:
+        save_statistics(username, len(batch) - 1)
+
+    charge_simulations(username, sum(spec["simulations"] for kind, spec in batch if kind == "pi"))
+    futures = []
+    for kind, spec in batch:
+        future = batch_executor.submit(run_batch_item, username, kind, spec)
+        if kind == "pi":    #a cancelled item gives its simulations back
+            future.add_done_callback(lambda future, n=spec["simulations"]: future.cancelled() and refund_simulations(username, n))
+        futures.append(future)
+    return futures, None
+
+#a failed item does not fail the batch
+def run_batch_item(username, kind, spec):
+    start_time = timeit.default_timer()
+    try:
+        if kind == "pi":
+            return {"type": kind, **run_pi_request(username, spec, start_time)}
+        return {"type": kind, **run_legacy_pi(spec, start_time)}
+    except Exception as e:
+        if kind == "pi":
+            refund_simulations(username, spec["simulations"])
+        return {"type": kind, "error": str(e)}
+
+def handle_batch(data):
+    start_time = timeit.default_timer()
+    futures, error = start_batch(data)
+    if error:
+        return error
+    results = [future.result() for future in futures]
+    return {"items": len(results), "results": results, "execution_time": timeit.default_timer()-start_time}, 200
+
+@routes.post("/batch")
+def batch():
+    body, status = handle_batch(request.get_json())
+    return jsonify(body), status
+
+#one NDJSON line per item as it finishes with its `index` in the batch, closing the
+#connection cancels the items that have not started
+@routes.post("/batch/stream")
+def batch_stream():
+    start_time = timeit.default_timer()
+    futures, error = start_batch(request.get_json())
+    if error:
+        body, status = error
+        return jsonify(body), status
+
+    def generate():
+        index = {future: i for i, future in enumerate(futures)}
+        try:
+            for future in as_completed(futures):
+                yield json.dumps({"index": index[future], **future.result()}) + "\n"
+        finally:
+            for future in futures:
+                future.cancel()
+        yield json.dumps({"done": True, "items": len(futures), "execution_time": timeit.default_timer()-start_time}) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+@routes.errorhandler(RateLimited)
+def rate_limited(e):
+    body, status, headers = e.response()
+    return jsonify(body), status, headers
+
+#route metrics, the duration of a streamed response is the time to its first byte
+def record_request(route, method, status, elapsed):
+    metrics.inc("http_requests_total", route=route, method=method, status=str(status))
+    metrics.observe("http_request_duration_seconds", elapsed, route=route)
+
+@routes.before_request
+def start_request_timer():
+    g.start_time = timeit.default_timer()
+
+@routes.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    record_request(route, request.method, response.status_code, timeit.default_timer() - g.start_time)
+    return response
+
+#per request profiling, the profile is saved when the response is closed so a
+#streamed response is profiled to its last line
+@routes.before_request
+def start_request_profile():
+    if profiles.token and profiles.authorized(request.headers.get("X-Profile")):
+        g.profile = profiles.start_request(request.path)
+
+@routes.after_request
+def finish_request_profile(response):
+    profiler = g.pop("profile", None)
+    if profiler is not None:
+        response.headers["X-Profile-File"] = profiler.path
+        response.call_on_close(partial(profiles.stop_request, profiler))
+    return response
+
+@routes.teardown_request
+def stop_request_profile(exc):
+    profiler = g.pop("profile", None)   #only left when the view failed
+    if profiler is not None:
+        profiles.stop_request(profiler)
+
+#profiles every request for `seconds`
+@routes.post("/profile")
+def profile():
+    data = request.get_json()
+    if not profiles.authorized(data.get("token")):
+        return jsonify({"error": "profile token error"}), 401
+
+    seconds = data.get("seconds")
+    if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds <= 0 or seconds > PROFILE_MAX_WINDOW:
+        return jsonify({"error": "invalid field seconds"}), 400
+
+    path = profiles.start_window(seconds)
+    if path is None:
+        return jsonify({"error": "profiling already running"}), 409
+    return jsonify({"profile": path, "seconds": seconds}), 202
+
+@routes.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
-    app.run(host=HOST, port=PORT,debug=True)
+    from werkzeug.serving import is_running_from_reloader
+    if is_running_from_reloader():  #the reloader parent only watches the files
+        get_pool()
+    get_app().run(host=HOST, port=PORT,debug=True)
     
\ No newline at end of file
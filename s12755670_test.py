@@ -1,12 +1,38 @@
-import unittest, json, os
+import unittest, asyncio, json, math, os, subprocess, sys, time, socket, tempfile
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 from flask import Flask, jsonify
+import benchmark
+import s12755670_asgi
+import s12755670_server
 
 
 HOST, PORT = "localhost", 5000
+LEGACY_HOST, LEGACY_PORT = "localhost", 31416
 STATS_FILE = 'user_statistics.txt'
-
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", 1))    #same as the server
+BATCH_STATISTICS = os.environ.get("PI_BATCH_STATISTICS", "batch")   #same as the server
+RATE_BURST = int(float(os.environ.get("PI_RATE_BURST", 100)))    #same as the server
+SIMULATIONS_PER_MINUTE = int(os.environ.get("PI_SIMULATIONS_PER_MINUTE", 1000000000))   #same as the server
+PROFILE_TOKEN = os.environ.get("PI_PROFILE_TOKEN", "")   #same as the server, empty when profiling is disabled
+
+
+#calls the ASGI app in the test process, returns the status, headers and json body
+def asgi_test(path, method="POST", body=b""):
+    messages = []
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    async def send(message):
+        messages.append(message)
+    scope = {"type": "http", "path": path, "method": method, "headers": []}
+    asyncio.run(s12755670_asgi.app(scope, receive, send))
+    start, response = messages
+    return start["status"], dict(start["headers"]), json.loads(response["body"])
+
+#the text file is only exported by the periodic flush of the server
+def wait_for_export():
+    time.sleep(2 * STATS_FLUSH_INTERVAL + 0.2)
 
 #R6
 def server_test(url, method=None, data=None):
@@ -116,6 +142,310 @@ class TestProjectServer(unittest.TestCase):
         pi_value = res_json.get("pi")
         self.assertTrue(pi_value >= 3.141 and pi_value <= 3.142)
 
+    #pi engine
+    def test_pi_invalid_engine(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100, "engine":"xxx"})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field engine"})
+
+    def test_pi_engine_python(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100000, "concurrency":2, "engine":"python"})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(res_json.get("engine"), "python")
+        pi_value = res_json.get("pi")
+        self.assertTrue(pi_value >= 3.10 and pi_value <= 3.20)
+
+    def test_pi_engine_numpy(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":10000000, "concurrency":2, "engine":"numpy"})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(res_json.get("engine"), "numpy")
+        pi_value = res_json.get("pi")
+        self.assertTrue(pi_value >= 3.14 and pi_value <= 3.15)
+
+    #pi seed
+    def test_pi_invalid_seed(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100, "seed":-1})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field seed"})
+
+    def test_pi_missing_seed(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(isinstance(res_json.get("seed"), int))
+
+    def test_pi_seed_reproducible(self):
+        results = []
+        for engine in ["python", "numpy"]:
+            for concurrency in [1, 3, 8]:
+                res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":300001, "concurrency":concurrency, "engine":engine, "seed":12345, "cache":False})
+                self.assertEqual(status_code, 200)
+                self.assertEqual(res_json.get("seed"), 12345)
+                results.append(res_json.get("pi"))
+        self.assertEqual(len(set(results[:3])), 1)
+        self.assertEqual(len(set(results[3:])), 1)
+
+    def test_pi_shards(self):
+        results = []
+        for shards in [None, 8, 50, 77]:
+            data = {"username":"1111", "password":"1111-pw", "simulations":5000001, "concurrency":4, "seed":777, "cache":False}
+            if shards:
+                data["shards"] = shards
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", data)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(res_json.get("samples"), 5000001)
+            self.assertEqual(res_json.get("shards"), shards)
+            results.append(res_json.get("pi"))
+        self.assertEqual(len(set(results)), 1)  #the shards only change how the blocks are accounted
+
+    def test_pi_invalid_shards(self):
+        for simulations, shards in [(5000001, 2), (5000001, 78), (1000, 4096), (5000001, "8"), (5000001, True)]:   #5000001 samples are 77 blocks
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":simulations, "concurrency":4, "shards":shards})
+            self.assertEqual(status_code, 400)
+            self.assertEqual(res_json, {"error": "invalid field shards"})
+
+    #pi precision mode
+    def test_pi_invalid_digits(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "digits":0})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field digits"})
+
+    def test_pi_unreachable_digits(self):
+        #not reachable within 100,000,000 simulations
+        for method, digits in [("monte_carlo", 4), ("qmc", 5), ("stratified", 5)]:
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "method":method, "digits":digits})
+            self.assertEqual(status_code, 400)
+            self.assertEqual(res_json, {"error": "invalid field digits"})
+
+    def test_pi_invalid_target_error(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "target_error":"0.01"})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field target_error"})
+
+    def test_pi_invalid_time_budget(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "digits":2, "time_budget":0})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field time_budget"})
+
+    def test_pi_digits(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "digits":2, "concurrency":4})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(res_json.get("target_met"))
+        self.assertTrue(res_json.get("samples") < 100000000)
+        low, high = res_json.get("confidence_interval")
+        self.assertTrue(low <= res_json.get("pi") <= high)
+        self.assertTrue(high - low <= 0.01)
+
+    def test_pi_target_error_time_budget(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "target_error":0.0000001, "time_budget":0.5, "engine":"python"})
+        self.assertEqual(status_code, 200)
+        self.assertFalse(res_json.get("target_met"))
+        self.assertTrue(res_json.get("execution_time") < 5)
+
+    #pi methods
+    def test_pi_invalid_method(self):
+        for method in ["sobol", 1, None]:
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100000, "method":method})
+            self.assertEqual(status_code, 400)
+            self.assertEqual(res_json, {"error": "invalid field method"})
+
+    def test_pi_methods(self):
+        errors = {}
+        for method in ["monte_carlo", "qmc", "stratified"]:
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":2000000, "concurrency":4, "method":method, "seed":31, "cache":False})
+            self.assertEqual(status_code, 200)
+            self.assertEqual(res_json.get("method"), method)
+            self.assertEqual(res_json.get("samples"), 2000000)
+            self.assertTrue(abs(res_json.get("pi") - math.pi) <= 2 * res_json.get("error_bound"))
+            errors[method] = res_json.get("standard_error")
+        self.assertTrue(errors["qmc"] < errors["monte_carlo"])
+        self.assertTrue(errors["stratified"] < errors["monte_carlo"])
+
+    def test_pi_method_digits(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "digits":3, "method":"stratified", "concurrency":4})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(res_json.get("target_met"))
+        self.assertTrue(res_json.get("error_bound") <= 0.0005)
+
+    def test_pi_series(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "method":"series", "digits":5000, "concurrency":4})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(res_json.get("pi"), math.pi)
+        self.assertTrue(res_json.get("pi_digits").startswith("3.14159265358979323846264338327950288419716939937510"))
+        self.assertEqual(len(res_json.get("pi_digits")), 5002)
+        self.assertEqual(res_json.get("error_bound"), "1e-5000")
+        other_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "method":"series", "digits":4000, "concurrency":1})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(res_json.get("pi_digits").startswith(other_json.get("pi_digits")))
+
+    def test_pi_series_invalid_digits(self):
+        for digits in [None, 0, 100001, "10"]:
+            data = {"username":"1111", "password":"1111-pw", "method":"series"}
+            if digits is not None:
+                data["digits"] = digits
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", data)
+            self.assertEqual(status_code, 400)
+            self.assertEqual(res_json, {"error": "missing field digits" if digits is None else "invalid field digits"})
+
+    def test_pi_series_stream_job(self):
+        for route in ["pi/stream", "pi/jobs"]:
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/{route}", "POST", {"username":"1111", "password":"1111-pw", "method":"series", "digits":100})
+            self.assertEqual(status_code, 400)
+            self.assertEqual(res_json, {"error": "invalid field method"})
+
+    #cache
+    def test_pi_invalid_cache(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100, "cache":"yes"})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field cache"})
+
+    def test_pi_cache_hit(self):
+        seed = int(time.time() * 1000)
+        first_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":1000000, "seed":seed})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(first_json.get("cache"), "miss")
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":1000000, "concurrency":4, "seed":seed})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(res_json.get("cache"), "hit")
+        self.assertEqual(res_json.get("concurrency"), 4)
+        self.assertEqual(res_json.get("pi"), first_json.get("pi"))
+
+    def test_pi_cache_hit_shards(self):
+        seed = int(time.time() * 1000) + 2
+        for shards, cache in [(15, "miss"), (8, "hit"), (None, "hit")]:
+            data = {"username":"1111", "password":"1111-pw", "simulations":1000000, "seed":seed}
+            if shards:
+                data["shards"] = shards
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", data)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(res_json.get("cache"), cache)
+            self.assertEqual(res_json.get("shards"), shards)    #the shards of the caller, not of the cached run
+
+    def test_pi_cache_coalesced(self):
+        req = {"username":"1111", "password":"1111-pw", "simulations":20000000, "seed":int(time.time() * 1000) + 1}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            set = [executor.submit(server_test, f"http://{HOST}:{PORT}/pi", "POST", req) for _ in range(4)]
+            results = [se.result()[0] for se in set]
+        self.assertEqual(len({res_json.get("pi") for res_json in results}), 1)
+        self.assertEqual(sorted(res_json.get("cache") for res_json in results).count("miss"), 1)
+
+    def test_cache_stats(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/cache", "POST", {"username":"1111", "password":"1111-pw"})
+        self.assertEqual(status_code, 200)
+        for key in ["hits", "misses", "coalesced", "evictions", "entries", "bytes"]:
+            self.assertTrue(isinstance(res_json.get(key), int))
+
+    #pi stream
+    def test_pi_stream_invalid_simulations(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/stream", "POST", {"username":"1111", "password":"1111-pw", "simulations":1})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field simulations"})
+
+    def test_pi_stream(self):
+        data = json.dumps({"username":"1111", "password":"1111-pw", "simulations":1000000, "concurrency":4, "seed":1}).encode()
+        req = Request(url=f"http://{HOST}:{PORT}/pi/stream", data=data, headers={"Content-type": "application/json; charset=UTF-8"}, method="POST")
+        with urlopen(req) as resp:
+            self.assertEqual(resp.getcode(), 200)
+            lines = [json.loads(line) for line in resp]
+        self.assertEqual(len(lines), 5)
+        self.assertEqual([line["shards_completed"] for line in lines[:-1]], [1, 2, 3, 4])
+        self.assertTrue(lines[-1]["done"])
+        self.assertEqual(lines[-1]["samples"], 1000000)
+        self.assertEqual(lines[-1]["pi"], lines[-2]["pi"])
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":1000000, "seed":1})
+        self.assertEqual(res_json.get("pi"), lines[-1]["pi"])
+
+    def test_pi_stream_shards(self):
+        data = json.dumps({"username":"1111", "password":"1111-pw", "simulations":5000000, "concurrency":2, "shards":70, "seed":1}).encode()
+        req = Request(url=f"http://{HOST}:{PORT}/pi/stream", data=data, headers={"Content-type": "application/json; charset=UTF-8"}, method="POST")
+        with urlopen(req) as resp:
+            lines = [json.loads(line) for line in resp]
+        progress = [line["shards_completed"] for line in lines[:-1]]
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 70)  #every task reports the shards it ran
+        self.assertEqual(lines[-1]["samples"], 5000000)
+
+    #pi jobs
+    def test_pi_job_invalid_simulations(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs", "POST", {"username":"1111", "password":"1111-pw", "simulations":1})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field simulations"})
+
+    def test_pi_job_not_found(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/xxx", "POST", {"username":"1111", "password":"1111-pw"})
+        self.assertEqual(status_code, 404)
+        self.assertEqual(res_json, {"error": "job not found"})
+
+    def test_pi_job_other_user(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs", "POST", {"username":"1111", "password":"1111-pw", "simulations":100})
+        self.assertEqual(status_code, 202)
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/{res_json['job_id']}", "POST", {"username":"1112", "password":"1112-pw"})
+        self.assertEqual(status_code, 404)
+
+    def test_pi_job_result(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs", "POST", {"username":"1111", "password":"1111-pw", "simulations":1000000, "concurrency":4, "seed":1})
+        self.assertEqual(status_code, 202)
+        job_id = res_json.get("job_id")
+        for _ in range(100):
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/{job_id}", "POST", {"username":"1111", "password":"1111-pw"})
+            self.assertEqual(status_code, 200)
+            if res_json.get("status") == "done":
+                break
+            time.sleep(0.1)
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/{job_id}/result", "POST", {"username":"1111", "password":"1111-pw"})
+        self.assertEqual(status_code, 200)
+        pi_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":1000000, "seed":1})
+        self.assertEqual(res_json.get("pi"), pi_json.get("pi"))
+
+    def test_job_store_cancel_queued(self):
+        #no worker threads, so the job stays queued
+        store = s12755670_server.JobStore(1, 1, 60)
+        quota = s12755670_server.simulation_quota
+        quota.take("job-store-test", quota.capacity)
+        pi_job = store.submit("job-store-test", {"simulations": 100000000})
+        self.assertIsNone(store.submit("job-store-test", {"simulations": 100}))     #queue full
+        store.cancel(pi_job)
+        store.cancel(pi_job)
+        self.assertEqual(pi_job.status, "cancelled")
+        self.assertTrue(quota.buckets["job-store-test"][0] < 150000000)     #refunded once
+        self.assertIsNotNone(store.submit("job-store-test", {"simulations": 100}))     #the slot is free again
+        for _ in range(100):    #cancelled jobs leave the queue, so it cannot grow
+            store.cancel(store.queue[0])
+            self.assertIsNotNone(store.submit("job-store-test", {"simulations": 100}))
+        self.assertEqual(len(store.queue), 1)
+
+    def test_job_store_shutdown(self):
+        store = s12755670_server.JobStore(4, 2, 60).start()
+        store.shutdown(5)
+        self.assertFalse(any(thread.is_alive() for thread in store.threads))
+        self.assertIsNone(store.submit("job-store-test", {"simulations": 100}))     #no new jobs
+
+    def test_pi_job_cancel(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs", "POST", {"username":"1111", "password":"1111-pw", "simulations":100000000, "concurrency":8, "engine":"python"})
+        self.assertEqual(status_code, 202)
+        job_id = res_json.get("job_id")
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/{job_id}/cancel", "POST", {"username":"1111", "password":"1111-pw"})
+        self.assertEqual(status_code, 200)
+        for _ in range(300):
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/{job_id}", "POST", {"username":"1111", "password":"1111-pw"})
+            if res_json.get("status") == "cancelled":
+                break
+            time.sleep(0.1)
+        self.assertEqual(res_json.get("status"), "cancelled")
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi/jobs/{job_id}/result", "POST", {"username":"1111", "password":"1111-pw"})
+        self.assertEqual(status_code, 409)
+
+    #pi worker pool
+    def test_pi_concurrent_requests(self):
+        req = {"username":"1111", "password":"1111-pw", "simulations":1000000, "concurrency":8}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            set = [executor.submit(server_test, f"http://{HOST}:{PORT}/pi", "POST", req) for _ in range(4)]
+            for se in set:
+                res_json, status_code = se.result()
+                self.assertEqual(status_code, 200)
+                self.assertEqual(res_json.get("concurrency"), 8)
+                pi_value = res_json.get("pi")
+                self.assertTrue(pi_value >= 3.10 and pi_value <= 3.20)
+
     #pi execution_time
     def test_pi_execution_time(self):
         high_concurrency_res_json, high_concurrency_status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100000, "concurrency":8})
@@ -128,6 +458,194 @@ class TestProjectServer(unittest.TestCase):
 
         self.assertLessEqual(low_concurrency_execution_time, high_concurrency_execution_time) #high < low, low > high
 
+    def test_benchmark_schedule(self):
+        body = {"username":"1111", "password":"1111-pw", "simulations":1000, "concurrency":2}
+        schedule = [(i * 0.05, "pi", body) for i in range(10)] + [(0.5, "statistics", {"username":"1111", "password":"1111-pw"})]
+        results = benchmark.run_schedule(f"http://{HOST}:{PORT}", schedule, 4)
+        self.assertEqual(results["pi"]["requests"], 10)
+        self.assertEqual(results["pi"]["status"], {"200": 10})
+        self.assertEqual(results["total"]["requests"], 11)
+        self.assertEqual(results["total"]["errors"], 0)
+        self.assertLessEqual(results["pi"]["p50_ms"], results["pi"]["p99_ms"])
+        self.assertEqual(benchmark.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(benchmark.percentile(list(range(1, 101)), 99), 99)
+
+    def test_lazy_imports(self):
+        #a fresh interpreter, this process has imported Flask already
+        code = "import sys, s12755670_server as s; print(sorted({'flask', 'numpy'} & set(sys.modules)), s.routes.app is None)"
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.stdout.split(), ["[]", "True"])
+        self.assertIs(s12755670_server.get_app(), s12755670_server.get_app())
+        self.assertIs(s12755670_server.app, s12755670_server.get_app())    #flask --app and gunicorn look up `app`
+
+
+    def test_metrics(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":100000, "concurrency":2})
+        self.assertEqual(status_code, 200)
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw"})
+        self.assertEqual(status_code, 400)
+        with urlopen(f"http://{HOST}:{PORT}/metrics") as resp:
+            self.assertEqual(resp.getcode(), 200)
+            self.assertTrue(resp.headers["Content-Type"].startswith("text/plain"))
+            text = resp.read().decode()
+        self.assertIn('http_requests_total{method="POST",route="/pi",status="200"}', text)
+        self.assertIn('http_requests_total{method="POST",route="/pi",status="400"}', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/pi",le="+Inf"}', text)
+        for stage in ["auth", "statistics_io", "pool_submit", "pool_queue_wait", "shard_compute"]:
+            self.assertIn(f'pi_stage_seconds_count{{stage="{stage}"}}', text)
+        for gauge in ["pi_pool_queue_depth", "pi_pool_running", "legacy_inflight_requests"]:
+            self.assertIn(f"# TYPE {gauge} gauge", text)
+
+
+    def read_profile(self, path):
+        for _ in range(50):     #saved when the response is closed
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+        return lines
+
+    def test_profile_invalid_token(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/profile", "POST", {"token":"wrong-token", "seconds":1})
+        self.assertEqual(status_code, 401)
+        self.assertEqual(res_json, {"error": "profile token error"})
+
+    @unittest.skipUnless(PROFILE_TOKEN, "PI_PROFILE_TOKEN not set")
+    def test_profile_request(self):
+        data = json.dumps({"username":"1111", "password":"1111-pw", "simulations":1000000, "concurrency":2, "engine":"python"}).encode()
+        req = Request(url=f"http://{HOST}:{PORT}/pi", data=data, method="POST",
+                      headers={"Content-type": "application/json; charset=UTF-8", "X-Profile": PROFILE_TOKEN})
+        with urlopen(req) as resp:
+            self.assertEqual(resp.getcode(), 200)
+            path = resp.headers["X-Profile-File"]
+        self.assertTrue(path.endswith(".folded"))
+        lines = self.read_profile(path)
+        self.assertTrue(any(line.startswith("request;") for line in lines))
+        self.assertTrue(any(line.startswith("worker;") and "myth_value" in line for line in lines))
+
+    @unittest.skipUnless(PROFILE_TOKEN, "PI_PROFILE_TOKEN not set")
+    def test_profile_window(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/profile", "POST", {"token":PROFILE_TOKEN, "seconds":0})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field seconds"})
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/profile", "POST", {"token":PROFILE_TOKEN, "seconds":1})
+        self.assertEqual(status_code, 202)
+        res_json_running, status_code = server_test(f"http://{HOST}:{PORT}/profile", "POST", {"token":PROFILE_TOKEN, "seconds":1})
+        self.assertEqual(status_code, 409)
+        server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1111", "password":"1111-pw", "simulations":500000, "concurrency":2, "engine":"python"})
+        time.sleep(1)
+        lines = self.read_profile(res_json["profile"])
+        self.assertTrue(any(line.startswith("worker;") for line in lines))
+
+
+    #batch
+    def test_batch(self):
+        items = [{"simulations":100000, "seed":7}, {"type":"legacy_pi", "protocol":"tcp", "concurrency":2},
+                 {"type":"pi", "simulations":200000, "concurrency":4, "seed":7}]
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/batch", "POST", {"username":"1114", "password":"1114-pw", "items":items})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(res_json["items"], 3)
+        results = res_json["results"]
+        self.assertEqual([result["type"] for result in results], ["pi", "legacy_pi", "pi"])
+        self.assertEqual([results[0]["simulations"], results[2]["simulations"]], [100000, 200000])
+        self.assertEqual(results[1]["num_requests"], 2)
+        single_json, status_code = server_test(f"http://{HOST}:{PORT}/pi", "POST", {"username":"1114", "password":"1114-pw", "simulations":200000, "seed":7, "cache":False})
+        self.assertEqual(single_json["pi"], results[2]["pi"])   #same result as a single request
+
+    def test_batch_invalid_item(self):
+        items = [{"simulations":100000}, {"type":"legacy_pi", "protocol":"xxx"}]
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/batch", "POST", {"username":"1114", "password":"1114-pw", "items":items})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field protocol", "item": 1})
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/batch", "POST", {"username":"1114", "password":"1114-pw", "items":[{"type":"xxx"}]})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field type", "item": 0})
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/batch", "POST", {"username":"1114", "password":"1114-pw"})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "missing field items"})
+
+    def test_batch_over_quota(self):
+        if not SIMULATIONS_PER_MINUTE:
+            self.skipTest("simulation quota disabled")
+        items = [{"simulations":100000000}] * (SIMULATIONS_PER_MINUTE // 100000000 + 1)
+        if len(items) > 100:
+            self.skipTest("quota bigger than a batch")
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/batch", "POST", {"username":"1114", "password":"1114-pw", "items":items})
+        self.assertEqual(status_code, 429)
+        self.assertEqual(res_json, {"error": "simulations over the quota"})
+
+    def test_batch_stream(self):
+        items = [{"type":"legacy_pi", "protocol":"udp"}, {"simulations":100000, "concurrency":2}, {"simulations":100000}]
+        data = json.dumps({"username":"1114", "password":"1114-pw", "items":items}).encode()
+        req = Request(url=f"http://{HOST}:{PORT}/batch/stream", data=data, headers={"Content-type": "application/json; charset=UTF-8"}, method="POST")
+        with urlopen(req) as resp:
+            self.assertEqual(resp.headers["Content-Type"], "application/x-ndjson")
+            lines = [json.loads(line) for line in resp.read().decode().splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(sorted(line["index"] for line in lines[:-1]), [0, 1, 2])
+        self.assertEqual(lines[0]["type"], "pi")    #the legacy request takes 0.5 seconds, it finishes last
+        self.assertEqual(lines[-1]["done"], True)
+
+    def test_batch_statistics(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1114", "password":"1114-pw"})
+        count = res_json.get("1114")
+        items = [{"simulations":100000}] * 3
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/batch", "POST", {"username":"1114", "password":"1114-pw", "items":items})
+        self.assertEqual(status_code, 200)
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1114", "password":"1114-pw"})
+        self.assertEqual(res_json.get("1114"), count + (1 if BATCH_STATISTICS == "batch" else 3) + 1)
+
+
+    #auth and rate limits
+    def test_rate_limit(self):
+        def send(_):
+            req = Request(url=f"http://{HOST}:{PORT}/pi", data=json.dumps({"username":"1119", "password":"1119-pw"}).encode(),
+                          headers={"Content-type": "application/json; charset=UTF-8"}, method="POST")
+            try:
+                with urlopen(req) as resp:
+                    return resp.getcode(), None, None
+            except HTTPError as e:
+                return e.code, json.loads(e.read().decode()), e.headers.get("Retry-After")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(send, range(RATE_BURST * 2)))
+        limited = [result for result in results if result[0] == 429]
+        self.assertGreater(len(limited), 0)
+        self.assertGreaterEqual(len(results) - len(limited), RATE_BURST)
+        self.assertTrue(all(status == 400 for status, _, _ in results if status != 429))   #missing field simulations
+        self.assertEqual(limited[0][1], {"error": "rate limit exceeded"})
+        self.assertGreaterEqual(int(limited[0][2]), 1)
+
+    def test_credentials_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "credentials.json")
+            with open(path, "w") as f:
+                json.dump({"alice": s12755670_server.hash_password("secret", iterations=1000)}, f)
+            store = s12755670_server.FileCredentials(path)
+            self.assertTrue(store.verify("alice", "secret"))
+            self.assertFalse(store.verify("alice", "Secret"))
+            self.assertFalse(store.verify("bob", "secret"))
+            authenticator = s12755670_server.Authenticator(store, 60, 2)
+            self.assertTrue(authenticator.verify("alice", "secret"))
+            os.remove(path)     #cached, the store is not read again
+            self.assertTrue(authenticator.verify("alice", "secret"))
+        rules = s12755670_server.RuleCredentials()
+        self.assertTrue(rules.verify("1111", "1111-pw"))
+        self.assertFalse(rules.verify("1111", "1112-pw"))
+        self.assertFalse(rules.verify("11111", "11111-pw"))
+
+    def test_token_buckets(self):
+        buckets = s12755670_server.TokenBuckets(10, 100)
+        self.assertEqual(buckets.take("a", 60), 0)
+        self.assertGreater(buckets.take("a", 60), 1)    #40 left, 2 seconds to refill 20
+        buckets.refund("a", 30)
+        self.assertEqual(buckets.take("a", 60), 0)
+        self.assertIsNone(buckets.take("b", 101))      #over the capacity, refused without going into debt
+        self.assertEqual(buckets.take("b", 100), 0)
+
 
     #legacy pi
     def test_legacy_pi_missing_protocol(self):
@@ -194,11 +712,130 @@ class TestProjectServer(unittest.TestCase):
         pi_value = res_json.get("pi")
         self.assertTrue(pi_value==0 or(pi_value >= 3 and pi_value <= 3.3))
 
+    def test_legacy_pi_invalid_concurrency_limit(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"udp", "concurrency":1000})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field concurrency"})
+
+    def test_legacy_pi_4_udp(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"udp", "concurrency":32})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(res_json.get("num_valid_results") > 0)
+        self.assertTrue(res_json.get("execution_time") < 3)
+        pi_value = res_json.get("pi")
+        self.assertTrue(pi_value==0 or(pi_value >= 3.05 and pi_value <= 3.25))
+
+    def test_legacy_pi_4_tcp(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"tcp", "concurrency":32})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(res_json.get("num_valid_results") > 0)
+        self.assertTrue(res_json.get("execution_time") < 3)
+        pi_value = res_json.get("pi")
+        self.assertTrue(pi_value==0 or(pi_value >= 3.05 and pi_value <= 3.25))
+
+    #legacy pi aggregation
+    def test_legacy_pi_invalid_estimator(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"tcp", "estimator":"max"})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field estimator"})
+
+    def test_legacy_pi_invalid_recover(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"tcp", "recover":1})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field recover"})
+
+    def test_legacy_pi_invalid_target_valid(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"tcp", "concurrency":2, "target_valid":100})
+        self.assertEqual(status_code, 400)
+        self.assertEqual(res_json, {"error": "invalid field target_valid"})
+
+    def test_legacy_pi_recover(self):
+        for estimator in ["median", "trimmed", "consensus"]:
+            res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"udp", "concurrency":16, "recover":True, "estimator":estimator})
+            self.assertEqual(status_code, 200)
+            self.assertEqual(res_json.get("estimator"), estimator)
+            self.assertTrue(res_json.get("num_recovered") <= res_json.get("num_valid_results") <= 16)
+            pi_value = res_json.get("pi")
+            self.assertTrue(pi_value >= 3.09 and pi_value <= 3.2)
+
+    def test_legacy_pi_target_valid(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/legacy_pi", "POST", {"username":"1112", "password":"1112-pw", "protocol":"tcp", "concurrency":4, "target_valid":8})
+        self.assertEqual(status_code, 200)
+        self.assertTrue(res_json.get("num_valid_results") >= 8)
+        self.assertEqual(res_json.get("num_requests") % 4, 0)
+
+    def test_aggregate_pi(self):
+        values = [3.10, 3.14, 3.15, 3.16, 3.9]
+        self.assertAlmostEqual(s12755670_server.aggregate_pi(values, [], "median"), 3.15)
+        self.assertAlmostEqual(s12755670_server.aggregate_pi(values, [], "consensus"), 3.1375)   #3.9 is dropped
+        self.assertAlmostEqual(s12755670_server.aggregate_pi([3.14], [3.17], "consensus"), (3.14 + 0.5 * 3.17) / 1.5)
+        #no value within LEGACY_MAX_ERROR of the median
+        self.assertAlmostEqual(s12755670_server.aggregate_pi([3.0, 3.2], [], "consensus"), 3.1)
+        self.assertEqual(s12755670_server.aggregate_pi([], [], "consensus"), 0)
+
+    #asgi app
+    def test_asgi_app(self):
+        status, headers, body = asgi_test("/pi", "GET")
+        self.assertEqual((status, headers[b"allow"], body), (405, b"POST", {"error": "method not allowed"}))
+        status, _, body = asgi_test("/pi", body=b"[1]")
+        self.assertEqual((status, body), (400, {"error": "invalid json"}))
+        status, _, body = asgi_test("/statistics", body=json.dumps({"username":"1111", "password":"wrong"}).encode())
+        self.assertEqual((status, body), (401, {"error": "user info error"}))
+
+    #legacy server
+    def test_legacy_server_oneshot(self):
+        with socket.create_connection((LEGACY_HOST, LEGACY_PORT)) as s:
+            pi = s.recv(1024)
+            self.assertTrue(len(pi) > 0)
+            self.assertEqual(s.recv(1024), b"")
+
+    def test_legacy_server_pipeline(self):
+        with socket.create_connection((LEGACY_HOST, LEGACY_PORT)) as s:
+            s.sendall(b"PIPELINE\n" + b"\n" * 3)
+            with s.makefile("rb") as f:
+                lines = [f.readline() for _ in range(3)]
+        self.assertEqual(len(lines), 3)
+        for line in lines:
+            self.assertTrue(line.endswith(b"\n") and len(line) > 1)
+
+    def test_legacy_client_keepalive(self):
+        #16 requests over at most 2 pipelined connections, all answered concurrently
+        client = s12755670_server.LegacyClient(LEGACY_HOST, LEGACY_PORT, 64, 2, 3, 0, 1, keepalive=True, pool_size=2).start()
+        try:
+            start = time.time()
+            replies = client.fetch("tcp", 16)
+            self.assertTrue(time.time() - start < 1.5)
+            self.assertNotIn(None, replies)
+            self.assertEqual(len(client.connections.connections), 2)
+        finally:
+            client.close()
+
+    def test_legacy_client_hedge_after_send(self):
+        class CountingClient(s12755670_server.LegacyClient):
+            attempts = 0
+            async def _attempt(self, *args):
+                CountingClient.attempts += 1
+                return await super()._attempt(*args)
+        async def hold(seconds):
+            async with client.semaphore:
+                await asyncio.sleep(seconds)
+
+        #the only slot is taken for 1 s, no hedge is sent while the attempt waits for it
+        client = CountingClient(LEGACY_HOST, LEGACY_PORT, 1, 2, 3, 3, 0.2).start()
+        try:
+            asyncio.run_coroutine_threadsafe(hold(1), client.loop)
+            time.sleep(0.1)
+            self.assertIsNotNone(client.fetch("udp", 1)[0])
+            self.assertTrue(CountingClient.attempts <= 2)
+        finally:
+            client.close()
+
     #statistics
     def test_get_statistics(self):
         res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"})
         self.assertEqual(status_code, 200)
         curr_stats = {}
+        wait_for_export()
         if os.path.exists(STATS_FILE):  #get current statustics from txt file
             with open(STATS_FILE, 'r') as f:
                 for line in f:
@@ -212,6 +849,7 @@ class TestProjectServer(unittest.TestCase):
         res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"})
         self.assertEqual(status_code, 200)
         curr_stats = {}
+        wait_for_export()
         if os.path.exists(STATS_FILE):  #get current statustics from txt file
             with open(STATS_FILE, 'r') as f:
                 for line in f:
@@ -232,6 +870,7 @@ class TestProjectServer(unittest.TestCase):
         res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"})
         self.assertEqual(status_code, 200)
         curr_stats = {}
+        wait_for_export()
         if os.path.exists(STATS_FILE):  #get current statustics from txt file
             with open(STATS_FILE, 'r') as f:
                 for line in f:
@@ -246,10 +885,22 @@ class TestProjectServer(unittest.TestCase):
         self.assertEqual(res_json.get("1112"), curr_stats["1112"])
         self.assertEqual(res_json.get("1113"), curr_stats["1113"])
 
+    def test_add_statistics_concurrent(self):
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"})
+        self.assertEqual(status_code, 200)
+        count = res_json.get("1113")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            set = [executor.submit(server_test, f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"}) for _ in range(40)]
+            for se in set:
+                self.assertEqual(se.result()[1], 200)
+        res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"})
+        self.assertEqual(res_json.get("1113"), count + 41)
+
     def test_add_statistics_statistics(self):
         res_json, status_code = server_test(f"http://{HOST}:{PORT}/statistics", "POST", {"username":"1113", "password":"1113-pw"})
         self.assertEqual(status_code, 200)
         curr_stats = {}
+        wait_for_export()
         if os.path.exists(STATS_FILE):  #get current statustics from txt file
             with open(STATS_FILE, 'r') as f:
                 for line in f:
@@ -260,5 +911,51 @@ class TestProjectServer(unittest.TestCase):
         curr_stats["1113"] += 1
         self.assertEqual(res_json.get("1113"), curr_stats["1113"])
 
+#legacy_pi_server.py --backend asyncio on a free port
+class TestLegacyAsyncioServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            cls.port = s.getsockname()[1]
+        cls.server = subprocess.Popen([sys.executable, "legacy_pi_server.py", "127.0.0.1", str(cls.port), "--backend", "asyncio"],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", cls.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait(10)
+
+    def test_oneshot(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as s:
+            s.settimeout(5)
+            pi = s.recv(1024)
+            self.assertTrue(len(pi) > 0)
+            self.assertEqual(s.recv(1024), b"")
+
+    def test_udp(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(5)
+            s.sendto(b"pi", ("127.0.0.1", self.port))
+            pi, _ = s.recvfrom(1024)
+            self.assertTrue(len(pi) > 0)
+
+    def test_pipeline(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as s:
+            s.settimeout(5)
+            start = time.time()
+            s.sendall(b"PIPELINE\n" + b"\n" * 8)
+            with s.makefile("rb") as f:
+                lines = [f.readline() for _ in range(8)]
+            self.assertTrue(time.time() - start < 2)     #answered concurrently
+        for line in lines:
+            self.assertTrue(line.endswith(b"\n") and len(line) > 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file